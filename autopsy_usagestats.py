@@ -1,10 +1,11 @@
-import inspect
-import tempfile
+import jarray
+import os
+import re
+import sys
+import threading
 import traceback
 import xml.etree.ElementTree as ET
-import json
 from java.util.logging import Level
-from java.io import File
 from org.sleuthkit.autopsy.coreutils import Logger
 from org.sleuthkit.autopsy.ingest import FileIngestModule
 from org.sleuthkit.datamodel import BlackboardArtifact
@@ -15,29 +16,69 @@ from org.sleuthkit.autopsy.ingest import IngestModuleFactoryAdapter
 from org.sleuthkit.autopsy.ingest import ModuleDataEvent
 from org.sleuthkit.autopsy.ingest import IngestServices
 from org.sleuthkit.datamodel import TskData
-from org.sleuthkit.autopsy.casemodule import Case
-from org.sleuthkit.autopsy.datamodel import ContentUtils
+from org.sleuthkit.datamodel import ReadContentInputStream
 
-def calc_last_time_active(xml_element, filename):
+from usagestats_decoder import iter_usagestats_file, DecodeError
+from usagestats_metrics import Metrics, timer, STAGE_ARTIFACT
+
+try:
+    from java.nio.file import Paths
+    from jdk.jfr import Configuration, Recording
+except ImportError:
+    # Java Flight Recorder needs Java 11+
+    Recording = None
+
+# Set this environment variable to a .jfr path to record the ingest with Java Flight Recorder
+JFR_ENVIRONMENT_VARIABLE = 'USAGESTATS_JFR'
+
+# The usagestats files are named after their EPOCH timestamp and found in directory:
+# /data/system/usagestats/ (or /data/system/usagestats/<user id>/ on newer Android versions)
+# In there you'll find directories called either /monthly or /daily or /weekly or /yearly
+# In these directories the usagestats files are found.
+USAGESTATS_PARENT_PATH = re.compile(r'/usagestats/(?:\d+/)?(?:daily|weekly|monthly|yearly)/$')
+
+
+def is_usagestats_file(abstract_file):
     """
-    Calculate the absolute time (in EPOCH) when an event was active for the last time.
-    :param xml_element: The element containing an lastTimeActive attribute
-    :param filename: A filename where the name contains digits only, representing the creation time in EPOCH.
-    :return: The EPOCH representation of the time an event was active for the last time.
+    Check, based on the file name and parent path only, if a file is an usagestats file.
+    :param abstract_file: The AbstractFile to check
+    :return: True if the file is named after an EPOCH timestamp and lives in an usagestats interval directory
     """
-    if 'lastTimeActive' in xml_element.keys():
-        relative_last_time_active = int(xml_element.attrib['lastTimeActive'])
+    return (abstract_file.getName().isdigit() and
+            USAGESTATS_PARENT_PATH.search(abstract_file.getParentPath()) is not None)
 
-        # Some events show the last_time_active as EPOCH already, which is indicated by starting with a minus sign
-        if relative_last_time_active < 0:
-            last_time_active = abs(relative_last_time_active)
 
-        # Otherwise we need to add the filename (which is the start time in EPOCH)
-        # to the relative time (represented in ms)
-        else:
-            last_time_active = int(filename) + relative_last_time_active
-        # time from ms to s since epoch
-        return last_time_active/1000
+class ContentStream(object):
+    """
+    Read-only file object over the content of an AbstractFile, so the parsers can read it directly
+    instead of from a temp file copy.
+    """
+    # Size of the Java buffer the content is read into
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, abstractFile):
+        self._stream = ReadContentInputStream(abstractFile)
+        self._buffer = jarray.zeros(self.BUFFER_SIZE, 'b')
+
+    def read(self, size=-1):
+        """
+        :param size: The maximum amount of bytes to read, or a negative number to read everything that is left
+        :return: The bytes read, an empty string at the end of the content
+        """
+        chunks = []
+        while size < 0 or size > 0:
+            wanted = self.BUFFER_SIZE if size < 0 else min(size, self.BUFFER_SIZE)
+            read = self._stream.read(self._buffer, 0, wanted)
+            if read < 0:
+                break
+            chunks.append(self._buffer[:read].tostring())
+            if size > 0:
+                # A short read is fine, the parsers keep reading until they get an empty string
+                break
+        return ''.join(chunks)
+
+    def close(self):
+        self._stream.close()
 
 
 # Factory that defines the name and details of the module and allows Autopsy
@@ -69,17 +110,52 @@ class AndroidUsagestatsFactory(IngestModuleFactoryAdapter):
 class AutopsyUsagestatsIngestModule(FileIngestModule):
     _logger = Logger.getLogger(AndroidUsagestatsFactory.moduleName)
 
-    def log(self, level, msg):
-        self._logger.logp(level, self.__class__.__name__, inspect.stack()[1][3], msg)
+    # The ingest modules (threads) of every ingest job, so the metrics of all threads are reported once
+    # the last module of a job shuts down
+    _jobs = {}
+    _jobsLock = threading.Lock()
+
+    def log(self, level, msg, *args):
+        """
+        Log a message, the message is only formatted (with %) when the level is enabled.
+        The name of the calling method is looked up from its frame, instead of building a full stack snapshot.
+        """
+        if not self._logger.isLoggable(level):
+            return
+        if args:
+            msg = msg % args
+        self._logger.logp(level, self.__class__.__name__, sys._getframe(1).f_code.co_name, msg)
 
     # Setup and configuration
     def startUp(self, context):
         self.filesFound = 0
+        self.filesSkipped = 0
+        # Counters of this thread only, so no locking is needed while processing files
+        self.metrics = Metrics()
+        self.threadName = threading.currentThread().getName()
+        self.jobId = context.getJobId()
+        self.startJob(self.jobId)
 
         # Throw an IngestModule.IngestModuleException exception if there was a problem setting up
         # raise IngestModuleException(IngestModule(), "Oh No!")
         pass
 
+    @classmethod
+    def startJob(cls, jobId):
+        """
+        Register an ingest module of a job, the first one starts the optional Java Flight Recorder recording.
+        :param jobId: The id of the ingest job
+        """
+        with cls._jobsLock:
+            job = cls._jobs.get(jobId)
+            if job is None:
+                job = cls._jobs[jobId] = {'active': 0, 'threads': [], 'metrics': Metrics(), 'recording': None}
+                jfrPath = os.environ.get(JFR_ENVIRONMENT_VARIABLE)
+                if jfrPath and Recording is not None:
+                    job['recording'] = Recording(Configuration.getConfiguration('profile'))
+                    job['recording'].start()
+            job['active'] += 1
+
     def process(self, datasource):
 
         # Skip everything that is not a file
@@ -88,72 +164,100 @@ class AutopsyUsagestatsIngestModule(FileIngestModule):
                 (not datasource.isFile())):
             return IngestModule.ProcessResult.OK
 
-        # The usagestats files are named after their EPOCH timestamp and found in directory:
-        # /data/system/usagestats/
-        # In there you'll find directories called either /monthly or /daily or /weekly or /yearly
-        # In these directories the usagestats files are found.
-        fileManager = Case.getCurrentCase().getServices().getFileManager()
-        monthly = fileManager.findFiles(datasource, "monthly%")
-        daily = fileManager.findFiles(datasource, "daily%")
-        weekly = fileManager.findFiles(datasource, "weekly%")
-        yearly = fileManager.findFiles(datasource, "yearly%")
-
-        # For an example, we will flag files with .txt in the name and make a blackboard artifact.
-        if datasource.getName().isnumeric():
-
-            self.log(Level.INFO, "Found a usagestats file: " + datasource.getLocalPath())
-            self.filesFound += 1
+        # Cheap checks on the name and path first, so nearly every file of the image is skipped
+        # without any database query or read. Only the path of the file itself is checked, so files that are added
+        # later in the ingest (extracted from archives or carved) are found as well.
+        if not is_usagestats_file(datasource):
+            self.filesSkipped += 1
+            return IngestModule.ProcessResult.OK
 
-            temporary = tempfile.NamedTemporaryFile()
-            ContentUtils.writeToFile(datasource, File(temporary.name))
+        self.filesFound += 1
+        started = timer()
+        fileMetrics = Metrics()
+        # Logging every record is only done at FINE level, the per file summary below is logged at INFO
+        logRecords = self._logger.isLoggable(Level.FINE)
 
-            try:
-                tree = ET.parse(temporary.name)
-                tree_root = tree.getroot()
+        # The format (XML or protobuf) is detected from the first bytes of the file.
+        # The records are streamed from the file, so only a single record is held in memory at once.
+        # The artifacts are collected and posted once per file, instead of refreshing the UI for every record.
+        artifacts = []
+        content = ContentStream(datasource)
+        try:
+            for record in iter_usagestats_file(content, datasource.getName(), fileMetrics):
+                package = record.package or ''
+                # TODO: use the other fields of the record too
+                # TODO: Also add artifacts to the timeline
+                art = datasource.newArtifact(BlackboardArtifact.ARTIFACT_TYPE.TSK_PROG_RUN)
+                attributes = [BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_PROG_NAME.getTypeID(), AndroidUsagestatsFactory.moduleName, package)]
+                if logRecords:
+                    self.log(Level.FINE, "Package Info: %s", package)
+                if record.time is not None:
+                    # time from ms to s since epoch
+                    secs_since_epoch = record.time // 1000
+                    attributes.append(BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_DATETIME, AndroidUsagestatsFactory.moduleName, secs_since_epoch))
+                    if logRecords:
+                        self.log(Level.FINE, "Datetime: %s", secs_since_epoch)
+                art.addAttributes(attributes)
+                artifacts.append(art)
 
-            except ET.ParseError:
-                self.log(Level.WARNING, "Can't parse this file as XML with xml.etree.ElementTree, skipping")
-                self.log(Level.WARNING, "For file: " + temporary.name)
-                return
+        except (ET.ParseError, DecodeError):
+            self.log(Level.WARNING, "Can't parse this file as XML or protobuf, skipping")
+            self.log(Level.WARNING, "For file: %s", datasource.getUniquePath())
 
-            # We have sucessfully parsed the usagestats xml.
-            # So continue processing
-
-            for xml_element in tree_root:
-                for child in xml_element:
-
-                        all_attributes = json.dumps(child.attrib)
-                        usage_type = xml_element.tag
-                        # If the attribute exists in this xml element, fetch its value. Otherwise set to ''
-
-                        last_active_time = calc_last_time_active(child, datasource.getName())
-                        package = child.attrib.get('package', '')
-                        # TODO: use these artifacts too
-                        time_active = child.attrib.get('timeActive', 0)
-                        app_launch = child.attrib.get('appLaunchCount', '')
-                        type_class = child.attrib.get('class', '')
-                        type_type = child.attrib.get('type', '')
-
-                        secs_since_epoch = calc_last_time_active(child, datasource.getName())
-                        # TODO: Also add artifacts to the timeline
-                        art = datasource.newArtifact(BlackboardArtifact.ARTIFACT_TYPE.TSK_PROG_RUN)
-                        prog_name = BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_PROG_NAME.getTypeID(), AndroidUsagestatsFactory.moduleName, package)
-                        self.log(Level.INFO, "Package Info: " + str(package))
-                        datetime = BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_DATETIME, AndroidUsagestatsFactory.moduleName, secs_since_epoch)
-                        self.log(Level.INFO, "Datetime: " + str(secs_since_epoch))
-                        art.addAttributes([prog_name, datetime])
-
-                        IngestServices.getInstance().fireModuleDataEvent(
-                            ModuleDataEvent(AndroidUsagestatsFactory.moduleName,
-                                            BlackboardArtifact.ARTIFACT_TYPE.TSK_PROG_RUN, None))
+        finally:
+            content.close()
+            # Also post the artifacts of a file that turned out to be truncated
+            self.postArtifacts(artifacts)
+            seconds = timer() - started
+            # The rest of the time of the file went to creating and posting the artifacts
+            fileMetrics.add(STAGE_ARTIFACT, seconds - fileMetrics.total(), rows=len(artifacts))
+            self.metrics.add_file(datasource.getUniquePath(), seconds, fileMetrics, datasource.getSize())
+            self.log(Level.INFO, "Usagestats file %s: %d records, %d ms, %d bytes", datasource.getUniquePath(),
+                     len(artifacts), int(seconds * 1000), datasource.getSize())
 
         return IngestModule.ProcessResult.OK
 
+    def postArtifacts(self, artifacts):
+        """
+        Let the rest of Autopsy know about the new artifacts of a file, with a single event.
+        :param artifacts: The TSK_PROG_RUN artifacts created for a file
+        """
+        if not artifacts:
+            return
+        IngestServices.getInstance().fireModuleDataEvent(
+            ModuleDataEvent(AndroidUsagestatsFactory.moduleName,
+                            BlackboardArtifact.ARTIFACT_TYPE.TSK_PROG_RUN, artifacts))
+
     # Where any shutdown code is run and resources are freed.
-    # TODO: Add any shutdown code that you need here.
     def shutDown(self):
-        # As a final part of this example, we'll send a message to the ingest inbox with the number of files found (in this thread)
+        threadSummary = {'thread': self.threadName, 'files_found': self.filesFound,
+                         'files_skipped': self.filesSkipped, 'records': self.metrics.record_rows(),
+                         'seconds': round(self.metrics.total(), 6)}
+        self.log(Level.INFO, "Usagestats metrics: %s", self.metrics.to_json(**threadSummary))
+
+        with self._jobsLock:
+            job = self._jobs[self.jobId]
+            job['threads'].append(threadSummary)
+            job['metrics'].merge(self.metrics)
+            job['active'] -= 1
+            if job['active']:
+                return
+            del self._jobs[self.jobId]
+
+        # The last module of the job sends a message to the ingest inbox, with the metrics of every thread
+        filesFound = sum(thread['files_found'] for thread in job['threads'])
+        filesSkipped = sum(thread['files_skipped'] for thread in job['threads'])
+        summary = job['metrics'].to_json(files_found=filesFound, files_skipped=filesSkipped,
+                                         threads=job['threads'])
+        self.log(Level.INFO, "Usagestats metrics of the ingest job: %s", summary)
         message = IngestMessage.createMessage(
             IngestMessage.MessageType.DATA, AndroidUsagestatsFactory.moduleName,
-            str(self.filesFound) + " files found")
-        ingestServices = IngestServices.getInstance().postMessage(message)
+            str(filesFound) + " files found, " + str(filesSkipped) + " files skipped", summary)
+        IngestServices.getInstance().postMessage(message)
+
+        if job['recording'] is not None:
+            jfrPath = os.environ.get(JFR_ENVIRONMENT_VARIABLE)
+            job['recording'].stop()
+            job['recording'].dump(Paths.get(jfrPath))
+            job['recording'].close()
+            self.log(Level.INFO, "Java Flight Recorder recording written to %s", jfrPath)
@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+
+import pytest
+
+import usagestats_conv
+from usagestats_conv import BatchWriter, create_table, ingest_directory, parse_usagestats_file, plan_ingest, \
+    start_file
+from usagestats_corpus import generate_corpus
+
+
+def count_rows(db):
+    return db.execute('SELECT count(*) FROM data').fetchone()[0]
+
+
+@pytest.fixture
+def usagestats(tmp_path):
+    path = str(tmp_path / 'usagestats')
+    generate_corpus(path, 'mixed', files_per_interval=2, packages=5, events=300)
+    return path
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_interrupted_ingest_is_resumed_without_duplicates(tmp_path, usagestats, dedup):
+    db, cursor = create_table(str(tmp_path / 'clean.db'))
+    ingest_directory(db, BatchWriter(db, 100, dedup=dedup), usagestats)
+    expected = count_rows(db)
+    db.close()
+
+    # Interrupt the ingest halfway through the first file, after some of its batches were committed
+    db, cursor = create_table(str(tmp_path / 'resumed.db'))
+    writer = BatchWriter(db, 100, dedup=dedup)
+    tasks, skipped = plan_ingest(db, usagestats)
+    start_file(db, writer, tasks[0])
+    parse_usagestats_file(tasks[0].root, tasks[0].filename, writer, tasks[0].file_id)
+    assert count_rows(db) > 0
+    db.close()
+
+    db, cursor = create_table(str(tmp_path / 'resumed.db'))
+    ingested, unchanged = ingest_directory(db, BatchWriter(db, 100, dedup=dedup), usagestats)
+    assert ingested == len(tasks)
+    assert count_rows(db) == expected
+    db.close()
+
+
+def test_rerun_skips_unchanged_files(tmp_path, usagestats):
+    db, cursor = create_table(str(tmp_path / 'usagestats.db'))
+    ingest_directory(db, BatchWriter(db), usagestats)
+    rows = count_rows(db)
+
+    ingested, unchanged = ingest_directory(db, BatchWriter(db), usagestats)
+    assert ingested == 0
+    assert count_rows(db) == rows
+    db.close()
+
+
+def test_parallel_ingest_writes_the_same_rows_as_serial(tmp_path, usagestats):
+    tables = []
+    for jobs in (1, 3):
+        db, cursor = create_table(str(tmp_path / ('jobs%d.db' % jobs)))
+        # A small batch size, so files are sent to the writer in several batches
+        ingest_directory(db, BatchWriter(db, 50), usagestats, jobs)
+        tables.append(db.execute('SELECT * FROM data ORDER BY id').fetchall())
+        db.close()
+    assert tables[0] == tables[1]
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='the patch only reaches forked workers')
+def test_parallel_ingest_fails_when_a_worker_dies(tmp_path, usagestats, monkeypatch):
+    parse = usagestats_conv.parse_usagestats_file
+
+    def die_on_weekly(root, filename, *args, **kwargs):
+        # Like the OOM killer, the worker is gone without sending an error
+        if os.path.basename(root) == 'weekly':
+            os._exit(9)
+        return parse(root, filename, *args, **kwargs)
+
+    monkeypatch.setattr(usagestats_conv, 'parse_usagestats_file', die_on_weekly)
+    db, cursor = create_table(str(tmp_path / 'usagestats.db'))
+    with pytest.raises(RuntimeError, match='exit code 9'):
+        ingest_directory(db, BatchWriter(db), usagestats, 2)
+    db.close()
+
+
+def test_columnar_export_holds_every_row_after_a_rerun(tmp_path, usagestats):
+    np = pytest.importorskip('numpy')
+    db_path = str(tmp_path / 'usagestats.db')
+    report_path = str(tmp_path / 'Report.html')
+    usagestats_conv.usagestats_parse(usagestats, db_path, report_path=report_path)
+
+    # Nothing changed, so nothing is ingested by this run
+    export_path = str(tmp_path / 'export.npz')
+    usagestats_conv.usagestats_parse(usagestats, db_path, report_path=report_path, columnar_path=export_path)
+
+    db, cursor = create_table(db_path)
+    with np.load(export_path) as columns:
+        assert len(columns['time']) == count_rows(db)
+    db.close()
@@ -0,0 +1,121 @@
+import io
+import random
+
+import pytest
+
+from usagestats_corpus import DAY_MS, _bytes_field, _varint_field, generate_interval, to_protobuf, to_xml
+from usagestats_decoder import (DecodeError, FORMAT_PROTOBUF, FORMAT_UNKNOWN, FORMAT_XML, UTF8_BOM, detect_format,
+                                iter_usagestats_file)
+
+FILENAME = '1589068800000'
+START = int(FILENAME)
+
+
+def decode(content):
+    return [record[:7] for record in iter_usagestats_file(io.BytesIO(content), FILENAME)]
+
+
+def expected_records(interval):
+    records = [('packages', START + stats['last_time_active_ms'], stats['package'], None, None,
+                stats['total_time_active_ms'], stats['app_launch_count']) for stats in interval['packages']]
+    records += [('configurations', START + configuration['last_time_active_ms'], None, None, None,
+                 configuration['total_time_active_ms'], None) for configuration in interval['configurations']]
+    records += [('event-log', START + event['time_ms'], event['package'], event.get('class'), event['type'], None,
+                 None) for event in interval['event_log']]
+    return records
+
+
+@pytest.mark.parametrize('encode', [to_xml, to_protobuf])
+def test_round_trip(encode):
+    interval = generate_interval(random.Random(0), DAY_MS, ['com.example.a', 'com.example.b'], 50)
+    assert decode(encode(interval, DAY_MS)) == expected_records(interval)
+
+
+@pytest.mark.parametrize('encode', [to_xml, to_protobuf])
+def test_negative_times_are_absolute(encode):
+    interval = {
+        'packages': [{'package': 'com.example.a', 'last_time_active_ms': -1589192784125, 'total_time_active_ms': 10,
+                      'app_launch_count': 1}],
+        'configurations': [],
+        'event_log': [{'time_ms': -1589192784126, 'package': 'com.example.a', 'type': 1}],
+    }
+    assert [record[1] for record in decode(encode(interval, DAY_MS))] == [1589192784125, 1589192784126]
+
+
+def test_inline_strings_and_stringpool_indexes():
+    content = b''.join([
+        # Package and class inline
+        _bytes_field(22, _bytes_field(1, b'com.example.inline') + _bytes_field(3, b'.Inline') +
+                     _varint_field(5, 1) + _varint_field(7, 1)),
+        # Package and class from the stringpool
+        _bytes_field(22, _varint_field(2, 1) + _varint_field(4, 2) + _varint_field(5, 2) + _varint_field(7, 2)),
+        # An inline string wins from an index, an index outside of the pool is left out
+        _bytes_field(22, _bytes_field(1, b'com.example.both') + _varint_field(2, 1) + _varint_field(4, 3) +
+                     _varint_field(5, 3) + _varint_field(7, 1)),
+        _bytes_field(2, _varint_field(1, 2) + _bytes_field(2, b'com.example.pool') + _bytes_field(2, b'.Pool')),
+    ])
+    assert [(record[2], record[3]) for record in decode(content)] == [
+        ('com.example.inline', '.Inline'), ('com.example.pool', '.Pool'), ('com.example.both', None)]
+
+
+@pytest.mark.parametrize('cut', [1, 5, 20])
+def test_truncated_file(cut):
+    interval = generate_interval(random.Random(0), DAY_MS, ['com.example.a'], 10)
+    with pytest.raises(DecodeError):
+        decode(to_protobuf(interval, DAY_MS)[:-cut])
+
+
+def decode_until_error(content):
+    records = []
+    with pytest.raises(DecodeError):
+        for record in iter_usagestats_file(io.BytesIO(content), FILENAME):
+            records.append(record[:7])
+    return records
+
+
+def test_records_survive_truncation():
+    interval = generate_interval(random.Random(0), DAY_MS, ['com.example.a', 'com.example.b'], 200)
+    content = to_protobuf(interval, DAY_MS)
+    expected = decode(content)
+
+    # The stringpool is written last, so it is lost: the names are left out
+    records = decode_until_error(content[:len(content) * 3 // 4])
+    assert len(records) > 100
+    assert [record[:2] + record[4:] for record in records] == [record[:2] + record[4:]
+                                                               for record in expected[:len(records)]]
+    assert all(record[2] is None and record[3] is None for record in records)
+
+    # Only the last string of the pool is lost, the records keep the names that are still in it
+    records = decode_until_error(content[:-1])
+    assert len(records) == len(expected)
+    assert {record[2] for record in expected} - {record[2] for record in records} == {'android'}
+    assert all(record == full or record[2] is None for record, full in zip(records, expected))
+
+
+def test_truncated_varint():
+    with pytest.raises(DecodeError):
+        decode(_varint_field(1, 5) + b'\x10\x80')
+
+
+@pytest.mark.parametrize('content', [
+    # Wire types 3 and 4 (groups), 6 and 7 don't exist in proto3
+    _varint_field(1, 5) + b'\x0b',
+    _varint_field(1, 5) + b'\x0f',
+    _bytes_field(22, _varint_field(7, 1) + b'\x2e'),
+])
+def test_unknown_wire_type(content):
+    with pytest.raises(DecodeError):
+        decode(content)
+
+
+@pytest.mark.parametrize('head, expected', [
+    (b'<?xml version="1.0"?><usagestats>', FORMAT_XML),
+    (UTF8_BOM + b'\n  <usagestats>', FORMAT_XML),
+    (_varint_field(1, DAY_MS), FORMAT_PROTOBUF),
+    (_bytes_field(22, b''), FORMAT_PROTOBUF),
+    (b'', FORMAT_UNKNOWN),
+    (b'\x00\x01', FORMAT_UNKNOWN),
+    (b'\x0b\x01', FORMAT_UNKNOWN),
+])
+def test_detect_format(head, expected):
+    assert detect_format(head) == expected
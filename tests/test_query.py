@@ -0,0 +1,104 @@
+import os
+import sqlite3
+
+import pytest
+
+from usagestats_conv import BatchWriter, create_table, ingest_directory
+from usagestats_query import UsagestatsQuery
+
+START = 1589068800000
+
+
+def write_file(usagestats, frequency, packages=(), events=()):
+    """
+    Write an XML usagestats file starting at START.
+    :param packages: (package, lastTimeActive, timeActive, appLaunchCount) tuples
+    :param events: (package, time, type) tuples
+    """
+    directory = os.path.join(usagestats, frequency)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<usagestats version="1">', '<packages>']
+    lines += ['<package package="%s" lastTimeActive="%d" timeActive="%d" appLaunchCount="%d" />' % package
+              for package in packages]
+    lines += ['</packages>', '<event-log>']
+    lines += ['<event package="%s" time="%d" type="%d" />' % event for event in events]
+    lines += ['</event-log>', '</usagestats>']
+    with open(os.path.join(directory, str(START)), 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def ingest(db_path, usagestats, dedup=False):
+    db, cursor = create_table(db_path)
+    ingest_directory(db, BatchWriter(db, dedup=dedup), usagestats)
+    return db
+
+
+@pytest.fixture
+def usagestats(tmp_path):
+    return str(tmp_path / 'usagestats')
+
+
+def test_pages_continue_within_rows_of_the_same_time(tmp_path, usagestats):
+    write_file(usagestats, 'daily', events=[('com.example.a', 50, 1)] + [('com.example.b', 100, 1)] * 7 +
+                                           [('com.example.a', 200, 2)])
+    db = ingest(str(tmp_path / 'usagestats.db'), usagestats)
+    query = UsagestatsQuery(db)
+
+    everything = [event for page in query.events(page_size=100) for event in page]
+    assert len(everything) == 9
+    pages = list(query.events(page_size=3))
+    assert [len(page) for page in pages] == [3, 3, 3]
+    assert [event for page in pages for event in page] == everything
+
+    # The time range is inclusive at the start and exclusive at the end
+    in_range = [event for page in query.events(START + 100, START + 200, page_size=2) for event in page]
+    assert [event.id for event in in_range] == [event.id for event in everything[1:8]]
+    db.close()
+
+
+def test_sources_filter_matches_deduplicated_events(tmp_path, usagestats):
+    write_file(usagestats, 'daily', events=[('com.example.both', 10, 1), ('com.example.daily', 20, 1)])
+    write_file(usagestats, 'weekly', events=[('com.example.both', 10, 1), ('com.example.weekly', 30, 1)])
+    db = ingest(str(tmp_path / 'usagestats.db'), usagestats, dedup=True)
+    query = UsagestatsQuery(db)
+
+    def packages(sources):
+        return [event.package for page in query.events(sources=sources) for event in page]
+
+    assert packages(['weekly']) == ['com.example.both', 'com.example.weekly']
+    assert packages(['daily']) == ['com.example.both', 'com.example.daily']
+    # Stored once, with the intervals it appeared in
+    assert packages(['daily', 'weekly']) == ['com.example.both', 'com.example.daily', 'com.example.weekly']
+    db.close()
+
+
+def test_aggregates_are_computed_again_after_a_file_changed(tmp_path, usagestats):
+    db_path = str(tmp_path / 'usagestats.db')
+    write_file(usagestats, 'daily', packages=[('com.example.a', 10, 1000, 3), ('com.example.b', 20, 2000, 1)])
+    db = ingest(db_path, usagestats)
+    query = UsagestatsQuery(db)
+    assert query.launch_counts() == [('com.example.a', 3), ('com.example.b', 1)]
+    assert db.execute('SELECT count(*) FROM aggregate_cache').fetchone()[0] == 1
+    db.close()
+
+    write_file(usagestats, 'daily', packages=[('com.example.a', 10, 1000, 3), ('com.example.b', 20, 2000, 5)])
+    db = ingest(db_path, usagestats)
+    assert UsagestatsQuery(db).launch_counts() == [('com.example.b', 5), ('com.example.a', 3)]
+    db.close()
+
+
+@pytest.mark.parametrize('cache_table', [False, True])
+def test_aggregates_of_a_read_only_database(tmp_path, usagestats, cache_table):
+    db_path = str(tmp_path / 'usagestats.db')
+    write_file(usagestats, 'daily', packages=[('com.example.a', 10, 1000, 3)])
+    db = ingest(db_path, usagestats)
+    if cache_table:
+        UsagestatsQuery(db).launch_counts()
+    db.close()
+
+    db = sqlite3.connect('file:%s?mode=ro' % db_path, uri=True)
+    query = UsagestatsQuery(db)
+    assert query.top_apps_per_day() == [('2020-05-10', 'com.example.a', 1000)]
+    assert query.launch_counts() == [('com.example.a', 3)]
+    db.close()
@@ -0,0 +1,95 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from usagestats_sessions import EVENT_DTYPE, NO_PACKAGE, Sessions
+
+
+def make_sessions(*sessions):
+    package, start, end = zip(*sessions) if sessions else ((), (), ())
+    return Sessions(np.array(package, dtype=np.int32), np.array(start, dtype=np.int64),
+                    np.array(end, dtype=np.int64), [])
+
+
+def test_foreground_at_finds_a_longer_session_that_started_earlier():
+    sessions = make_sessions((1, 0, 100), (2, 10, 20))
+    assert list(sessions.foreground_at([-5, 0, 15, 20, 50, 99, 100])) == [NO_PACKAGE, 1, 2, 1, 1, 1, NO_PACKAGE]
+
+
+def test_foreground_at_without_sessions():
+    sessions = make_sessions()
+    assert list(sessions.foreground_at([0, 10])) == [NO_PACKAGE, NO_PACKAGE]
+
+
+def test_foreground_at_matches_the_last_started_covering_session():
+    random = np.random.default_rng(0)
+    start = random.integers(0, 10000, 500)
+    end = start + random.integers(0, 2000, 500)
+    sessions = make_sessions(*zip(np.arange(500), start, end))
+    times = np.arange(-10, 12010, 7)
+
+    expected = []
+    for time in times:
+        covering = np.flatnonzero((sessions.start <= time) & (sessions.end > time))
+        expected.append(sessions.package[covering[-1]] if len(covering) else NO_PACKAGE)
+    assert list(sessions.foreground_at(times)) == expected
+
+
+FOREGROUND = 1
+BACKGROUND = 2
+SCREEN_OFF = 16
+KEYGUARD = 17
+
+A = 1
+B = 2
+
+
+def from_events(*events):
+    """
+    :param events: (time, package, type) tuples
+    :return: The (package, start, end) tuples of the sessions
+    """
+    sessions = Sessions.from_events(np.array(list(events), dtype=EVENT_DTYPE), [])
+    return list(zip(sessions.package.tolist(), sessions.start.tolist(), sessions.end.tolist()))
+
+
+def test_from_events_pairs_the_last_foreground_event_with_the_background_event():
+    assert from_events((0, A, FOREGROUND), (10, A, FOREGROUND), (20, A, BACKGROUND)) == [(A, 10, 20)]
+
+
+def test_from_events_ignores_background_events_of_other_packages():
+    assert from_events((0, A, FOREGROUND), (5, B, BACKGROUND), (10, A, BACKGROUND)) == [(A, 0, 10)]
+
+
+@pytest.mark.parametrize('end_type', [SCREEN_OFF, KEYGUARD])
+def test_from_events_ends_sessions_at_screen_off_and_keyguard(end_type):
+    assert from_events((0, A, FOREGROUND), (2, B, FOREGROUND), (5, NO_PACKAGE, end_type), (10, A, BACKGROUND),
+                       (12, B, BACKGROUND), (20, A, FOREGROUND), (30, A, BACKGROUND)) == [
+        (A, 0, 5), (B, 2, 5), (A, 20, 30)]
+
+
+def test_from_events_counts_copies_from_several_interval_files_once():
+    events = [(0, A, FOREGROUND), (10, A, BACKGROUND), (20, B, FOREGROUND), (30, B, BACKGROUND)]
+    # Like the daily, weekly, monthly and yearly files, in the order the files are read
+    assert from_events(*(events * 4)) == [(A, 0, 10), (B, 20, 30)]
+
+
+DAY = 1589068800000  # 2020-05-10 00:00 UTC
+HOUR_MS = 60 * 60 * 1000
+
+
+def screen_time(sessions, utc_offset_ms=0):
+    return [(str(day), package, duration) for day, package, duration in
+            make_sessions(*sessions).daily_screen_time(utc_offset_ms).tolist()]
+
+
+def test_daily_screen_time_splits_sessions_at_midnight():
+    sessions = [(A, DAY - 1000, DAY + 2000), (B, DAY + 5000, DAY + 6000)]
+    assert screen_time(sessions) == [('2020-05-09', A, 1000), ('2020-05-10', A, 2000), ('2020-05-10', B, 1000)]
+
+
+def test_daily_screen_time_splits_sessions_at_local_midnight():
+    sessions = [(A, DAY - 1000, DAY + 2000), (B, DAY + HOUR_MS - 500, DAY + HOUR_MS + 500)]
+    # In UTC-1 the first session is within a single day, the second one runs past midnight
+    assert screen_time(sessions, -HOUR_MS) == [('2020-05-09', A, 3000), ('2020-05-09', B, 500),
+                                               ('2020-05-10', B, 500)]
@@ -0,0 +1,26 @@
+import io
+
+from usagestats_xml import iter_usagestats_records
+
+XML = b'''<?xml version='1.0' encoding='utf-8' standalone='yes' ?>
+<usagestats version="1" endTime="1000">
+    <packages>
+        <package lastTimeActive="12x" package="com.example.broken" timeActive="5" />
+        <package lastTimeActive="100" package="com.example.app" timeActive="10" />
+    </packages>
+    <event-log>
+        <event time="" package="com.example.app" type="1" />
+        <event time="-1589192784125" package="com.example.app" type="2" />
+    </event-log>
+</usagestats>
+'''
+
+
+def test_malformed_times_are_left_out_without_dropping_the_file():
+    records = list(iter_usagestats_records(io.BytesIO(XML), '1589000000000'))
+    assert [(record.package, record.time) for record in records] == [
+        ('com.example.broken', None),
+        ('com.example.app', 1589000000100),
+        ('com.example.app', None),
+        ('com.example.app', 1589192784125),
+    ]
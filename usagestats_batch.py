@@ -0,0 +1,224 @@
+"""
+Triage a batch of device extractions at once.
+
+Every extraction root is searched for its usagestats directory, and every device gets its own database, report,
+metrics and log in <output>/<device id>/. The devices are parsed concurrently by usagestats_conv.py processes,
+at most --concurrency at once, scheduled with asyncio.
+
+The state of the batch is kept in <output>/batch.json. Running the same batch again resumes it: devices that
+finished are skipped, the others are parsed again. A device that was interrupted only parses the files that weren't
+ingested yet, as its database keeps a manifest of the ingested files.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+CONV_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usagestats_conv.py')
+
+STATE_FILE = 'batch.json'
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_MISSING = 'missing'
+
+
+def find_usagestats_dir(root):
+    """
+    Search the extraction level by level, so the usagestats directory closest to the root is found.
+    :param root: The root of a device extraction, or its usagestats directory itself
+    :return: The shallowest directory named usagestats (the first in name order on the same level),
+             or None when the extraction has none
+    """
+    if os.path.basename(os.path.normpath(root)) == 'usagestats':
+        return root
+    level = [root]
+    while level:
+        next_level = []
+        for directory in level:
+            try:
+                names = sorted(entry.name for entry in os.scandir(directory)
+                               if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+            if 'usagestats' in names:
+                return os.path.join(directory, 'usagestats')
+            next_level.extend(os.path.join(directory, name) for name in names)
+        level = next_level
+    return None
+
+
+def device_id(root):
+    """
+    Name a device after its extraction root. A short hash of the absolute path keeps roots with the same name apart,
+    and gives a root the same id whatever its position in the batch.
+    :param root: The extraction root
+    :return: The device id, usable as directory name
+    """
+    path = os.path.abspath(root)
+    name = re.sub(r'[^\w.-]', '_', os.path.basename(os.path.normpath(path))) or 'device'
+    return name + '_' + hashlib.sha256(path.encode('utf-8')).hexdigest()[:8]
+
+
+def load_state(path):
+    """
+    :return: The state of a previous run of the batch, a dict with a dict per device id
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['devices']
+
+
+def save_state(path, devices):
+    # Replace the file at once, so an interrupted batch never leaves half a state file behind
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'updated': time.time(), 'devices': devices}, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+class Batch:
+    """
+    Runs usagestats_conv.py for every device of the batch, with bounded concurrency.
+    """
+
+    def __init__(self, roots, output, concurrency, conv_args=(), retry_failed=False):
+        """
+        :param roots: The device extraction roots
+        :param output: The directory to write the results of every device to
+        :param concurrency: The amount of devices parsed at once
+        :param conv_args: Extra arguments for usagestats_conv.py, like -j or --dedup
+        :param retry_failed: Also parse the devices that failed in a previous run
+        """
+        self.output = output
+        self.concurrency = max(1, concurrency)
+        self.conv_args = list(conv_args)
+        self.state_path = os.path.join(output, STATE_FILE)
+        self.started = None
+        self.finished = 0
+        self.todo = []
+
+        previous = load_state(self.state_path)
+        self.devices = {}
+        for root in roots:
+            device = previous.get(device_id(root))
+            if device is None:
+                device = {'root': os.path.abspath(root), 'status': STATUS_PENDING}
+            elif device['root'] != os.path.abspath(root):
+                # Never add the rows of a device to the database of another one
+                device = {'root': os.path.abspath(root), 'status': STATUS_PENDING, 'rebuild': True}
+            elif device['status'] == STATUS_RUNNING or (device['status'] in (STATUS_FAILED, STATUS_MISSING) and
+                                                        retry_failed):
+                device['status'] = STATUS_PENDING
+            self.devices[device_id(root)] = device
+
+    def pending(self):
+        return [device_id for device_id, device in self.devices.items() if device['status'] == STATUS_PENDING]
+
+    def progress(self, device_id, message):
+        print('[%d/%d] %s: %s' % (self.finished, len(self.todo), device_id, message), flush=True)
+
+    async def run(self):
+        """
+        Parse every pending device.
+        :return: The amount of devices that failed
+        """
+        os.makedirs(self.output, exist_ok=True)
+        self.todo = self.pending()
+        skipped = len(self.devices) - len(self.todo)
+        if skipped:
+            print('Resuming batch, ' + str(skipped) + ' devices were finished before', flush=True)
+        save_state(self.state_path, self.devices)
+
+        self.started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self.run_device(device_id, semaphore) for device_id in self.todo])
+        return sum(1 for device in self.devices.values() if device['status'] in (STATUS_FAILED, STATUS_MISSING))
+
+    async def run_device(self, device_id, semaphore):
+        device = self.devices[device_id]
+        async with semaphore:
+            usagestats_dir = await asyncio.get_running_loop().run_in_executor(None, find_usagestats_dir,
+                                                                              device['root'])
+            if usagestats_dir is None:
+                self.finish(device_id, STATUS_MISSING, 'no usagestats directory found')
+                return
+
+            device_dir = os.path.join(self.output, device_id)
+            os.makedirs(device_dir, exist_ok=True)
+            device.update({
+                'usagestats': usagestats_dir,
+                'db': os.path.join(device_dir, 'usagestats.db'),
+                'report': os.path.join(device_dir, 'Report.html'),
+                'metrics': os.path.join(device_dir, 'metrics.json'),
+                'log': os.path.join(device_dir, 'usagestats.log'),
+                'status': STATUS_RUNNING,
+            })
+            save_state(self.state_path, self.devices)
+            self.progress(device_id, 'started')
+
+            started = time.perf_counter()
+            with open(device['log'], 'w') as log:
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable, CONV_SCRIPT, usagestats_dir, '--db', device['db'], '--report', device['report'],
+                    '--metrics', device['metrics'], *self.conv_args + (['--rebuild'] if device.get('rebuild') else []),
+                    stdout=log, stderr=asyncio.subprocess.STDOUT)
+                try:
+                    returncode = await process.wait()
+                except asyncio.CancelledError:
+                    # Interrupted, the device stays running in the state file so a resume parses it again
+                    process.kill()
+                    raise
+            device['seconds'] = round(time.perf_counter() - started, 3)
+
+        if returncode:
+            self.finish(device_id, STATUS_FAILED, 'failed with exit code %d, see %s' % (returncode, device['log']))
+            return
+        device.pop('rebuild', None)
+        with open(device['metrics']) as f:
+            metrics = json.load(f)
+        device['files'] = metrics['files']
+        device['rows'] = metrics['rows_written']
+        self.finish(device_id, STATUS_DONE, '%d files, %d rows in %.1f s' % (device['files'], device['rows'],
+                                                                              device['seconds']))
+
+    def finish(self, device_id, status, message):
+        self.devices[device_id]['status'] = status
+        self.finished += 1
+        save_state(self.state_path, self.devices)
+        self.progress(device_id, message)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse the usagestats of many device extractions at once.')
+    parser.add_argument('roots', nargs='+', help='The roots of the device extractions (or their usagestats '
+                                                 'directories)')
+    parser.add_argument('-o', '--output', default='batch', help='The directory to write the results to, '
+                                                                'a batch is resumed from here')
+    parser.add_argument('-c', '--concurrency', type=int, default=os.cpu_count() or 1,
+                        help='Amount of devices parsed at once')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Amount of worker processes per device')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Store the events that are copied into several interval files once')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Parse every file again, instead of only the files that are new or changed')
+    parser.add_argument('--retry-failed', action='store_true', help='Also parse the devices that failed before')
+    args = parser.parse_args()
+
+    conv_args = ['-j', str(args.jobs)]
+    if args.dedup:
+        conv_args.append('--dedup')
+    if args.rebuild:
+        conv_args.append('--rebuild')
+
+    batch = Batch(args.roots, args.output, args.concurrency, conv_args, args.retry_failed)
+    failed = asyncio.run(batch.run())
+    print('Batch completed in %.1f s, %d devices failed. See %s.' % (
+        time.perf_counter() - batch.started, failed, os.path.join(args.output, STATE_FILE)))
+    sys.exit(1 if failed else 0)
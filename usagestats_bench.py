@@ -0,0 +1,209 @@
+"""
+Benchmark the stages of usagestats_conv.py on a usagestats directory, by default a synthetic one
+generated with usagestats_corpus.py.
+
+Stages:
+    parse: stream the records of the XML files
+    decode: decode the records of the protobuf files
+    db_write: ingest every file into a fresh database
+    report: write the HTML report of that database
+
+Every stage runs in its own process, so the peak RSS of a stage isn't influenced by the other stages.
+The results are written as JSON, to compare them between releases.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import tempfile
+import time
+import traceback
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak RSS is left out there
+    resource = None
+
+import usagestats_conv
+from usagestats_corpus import generate_corpus
+from usagestats_decoder import detect_format, iter_usagestats_file, FORMAT_XML, FORMAT_PROTOBUF, HEAD_SIZE
+
+STAGES = ('parse', 'decode', 'db_write', 'report')
+
+BENCH_DB = 'bench.db'
+BENCH_REPORT = 'bench_report.html'
+
+# Seconds between the checks whether the process of a stage is still alive
+POLL_SECONDS = 1
+
+
+def _files_of_format(dirpath, file_format):
+    """
+    :return: A list with the paths of the usagestats files of a format
+    """
+    paths = []
+    for root, filename in usagestats_conv.iter_usagestats_files(dirpath):
+        path = os.path.join(root, filename)
+        with open(path, 'rb') as f:
+            if detect_format(f.read(HEAD_SIZE)) == file_format:
+                paths.append(path)
+    return paths
+
+
+def _count_records(paths):
+    rows = 0
+    for path in paths:
+        for _ in iter_usagestats_file(path, os.path.basename(path)):
+            rows += 1
+    return {'files': len(paths), 'rows': rows, 'input_bytes': sum(os.path.getsize(path) for path in paths)}
+
+
+def stage_parse(dirpath, workdir, jobs, batch_size):
+    return _count_records(_files_of_format(dirpath, FORMAT_XML))
+
+
+def stage_decode(dirpath, workdir, jobs, batch_size):
+    return _count_records(_files_of_format(dirpath, FORMAT_PROTOBUF))
+
+
+def stage_db_write(dirpath, workdir, jobs, batch_size):
+    db_path = os.path.join(workdir, BENCH_DB)
+    db, cursor = usagestats_conv.create_table(db_path, rebuild=True)
+    writer = usagestats_conv.BatchWriter(db, batch_size)
+    ingested, unchanged = usagestats_conv.ingest_directory(db, writer, dirpath, jobs)
+    db.close()
+    output_bytes = sum(os.path.getsize(db_path + suffix) for suffix in ('', '-wal') if os.path.exists(db_path + suffix))
+    return {'files': ingested, 'rows': writer.rows_written, 'transactions': writer.transactions,
+            'output_bytes': output_bytes}
+
+
+def stage_report(dirpath, workdir, jobs, batch_size):
+    import sqlite3
+    report_path = os.path.join(workdir, BENCH_REPORT)
+    db = sqlite3.connect(os.path.join(workdir, BENCH_DB))
+    rows = usagestats_conv.write_report(db, report_path)
+    db.close()
+    return {'files': 1, 'rows': rows, 'output_bytes': os.path.getsize(report_path)}
+
+
+STAGE_FUNCTIONS = {
+    'parse': stage_parse,
+    'decode': stage_decode,
+    'db_write': stage_db_write,
+    'report': stage_report,
+}
+
+
+def _run_stage(stage, dirpath, workdir, jobs, batch_size, results):
+    started = time.perf_counter()
+    try:
+        result = STAGE_FUNCTIONS[stage](dirpath, workdir, jobs, batch_size)
+    except Exception:
+        # Report the error instead of the result, the parent would wait for the result forever
+        results.put({'stage': stage, 'error': traceback.format_exc()})
+        return
+    seconds = time.perf_counter() - started
+
+    result['stage'] = stage
+    result['seconds'] = seconds
+    result['files_per_sec'] = result['files'] / seconds if seconds else None
+    result['rows_per_sec'] = result['rows'] / seconds if seconds else None
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux, but in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['peak_rss_bytes'] = peak if platform.system() == 'Darwin' else peak * 1024
+    results.put(result)
+
+
+def run_benchmarks(dirpath, workdir, jobs=1, batch_size=usagestats_conv.DEFAULT_BATCH_SIZE, stages=STAGES):
+    """
+    Run the stages, each in a fresh process.
+    :param dirpath: The usagestats directory to benchmark with
+    :param workdir: The directory for the database and report, the report stage uses the database of db_write
+    :param jobs: The amount of worker processes of the db_write stage
+    :param batch_size: The batch size of the db_write stage
+    :param stages: The stages to run
+    :return: A list with the results per stage
+    :raises RuntimeError: When a stage fails, or its process dies without a result
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for stage in stages:
+        stage_results = context.Queue()
+        process = context.Process(target=_run_stage, args=(stage, dirpath, workdir, jobs, batch_size, stage_results))
+        process.start()
+        try:
+            while True:
+                try:
+                    result = stage_results.get(timeout=POLL_SECONDS)
+                    break
+                except queue.Empty:
+                    # Killed (like by the OOM killer) or crashed without putting a result
+                    if not process.is_alive() and stage_results.empty():
+                        raise RuntimeError('Stage %s died with exit code %s' % (stage, process.exitcode))
+        finally:
+            process.join()
+        if 'error' in result:
+            raise RuntimeError('Stage %s failed:\n%s' % (stage, result['error']))
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of usagestats_conv.py.')
+    parser.add_argument('--corpus', help='The usagestats directory to benchmark with, '
+                                         'a synthetic one is generated when left out')
+    parser.add_argument('--format', default='mixed', choices=('xml', 'protobuf', 'mixed'),
+                        help='Format of the generated files')
+    parser.add_argument('--files', type=int, default=4, help='Amount of generated files per interval directory')
+    parser.add_argument('--packages', type=int, default=50, help='Amount of packages per generated file')
+    parser.add_argument('--events', type=int, default=1000, help='Amount of events per generated file')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Amount of worker processes of db_write')
+    parser.add_argument('--batch-size', type=int, default=usagestats_conv.DEFAULT_BATCH_SIZE,
+                        help='Batch size of db_write')
+    parser.add_argument('--stage', action='append', choices=STAGES,
+                        help='Only run this stage, can be given more than once')
+    parser.add_argument('--label', default='', help='Label of the results, like the release being benchmarked')
+    parser.add_argument('--output', default='bench.json', help='The JSON file to write the results to')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='usagestats_bench_')
+    try:
+        corpus = {'path': args.corpus}
+        dirpath = args.corpus
+        if dirpath is None:
+            dirpath = os.path.join(workdir, 'usagestats')
+            files, size = generate_corpus(dirpath, args.format, args.files, args.packages, args.events, args.seed)
+            corpus = {'format': args.format, 'files': files, 'bytes': size, 'packages': args.packages,
+                      'events': args.events, 'seed': args.seed}
+
+        stages = args.stage or STAGES
+        if 'report' in stages and 'db_write' not in stages:
+            raise SystemExit('The report stage needs the db_write stage')
+        results = run_benchmarks(dirpath, workdir, args.jobs, args.batch_size, stages)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = {
+        'label': args.label,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'jobs': args.jobs,
+        'batch_size': args.batch_size,
+        'corpus': corpus,
+        'stages': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for result in results:
+        print('%-8s %6d files %9d rows %8.3f s %10.0f rows/sec' % (
+            result['stage'], result['files'], result['rows'], result['seconds'], result['rows_per_sec'] or 0))
+    print('Results written to ' + args.output)
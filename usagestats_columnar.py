@@ -0,0 +1,177 @@
+"""
+Columnar export of the usagestats rows, so the events of many devices can be loaded into pandas/arrow at once.
+
+A .parquet file needs pyarrow, a .npz file needs numpy. Neither is needed for the rest of the tools, so they are
+only imported when a ColumnarWriter is created, and only the one for its format.
+
+Columns:
+    time: int64, ms since EPOCH
+    usage_type: dictionary encoded (packages, configurations or event-log)
+    package, class: dictionary encoded, both use one dictionary like the stringpool of the protobuf files
+    type: uint8, the EventType of event-log rows
+    source: dictionary encoded (daily, weekly, monthly or yearly)
+
+Missing values are null in Parquet. In .npz they are NO_VALUE, or NO_TYPE for the type column.
+The dictionaries are stored in the .npz as the strings, usage_types and sources arrays.
+"""
+# Amount of rows collected before they are converted to columns
+DEFAULT_CHUNK_ROWS = 65536
+
+# Markers for missing values in the .npz arrays
+NO_VALUE = -1
+NO_TYPE = 255
+
+FORMAT_PARQUET = 'parquet'
+FORMAT_NPZ = 'npz'
+
+
+class ColumnarWriter:
+    """
+    Collects rows and writes them as columns, one chunk of chunk_rows at a time.
+    A Parquet file gets a row group per chunk. The chunks of a .npz file are kept as compact arrays
+    and are saved when the writer is closed, as a .npz can't be appended to.
+    """
+
+    def __init__(self, path, chunk_rows=DEFAULT_CHUNK_ROWS):
+        """
+        :param path: The file to write, ending with .parquet or .npz
+        :param chunk_rows: The amount of rows converted to columns at once
+        """
+        if path.endswith('.parquet'):
+            try:
+                import pyarrow
+                import pyarrow.compute
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('pyarrow is needed to export to Parquet')
+            self.format = FORMAT_PARQUET
+        elif path.endswith('.npz'):
+            try:
+                import numpy
+            except ImportError:
+                raise ImportError('numpy is needed to export to .npz')
+            self.format = FORMAT_NPZ
+        else:
+            raise ValueError('Unknown columnar format, use a .parquet or .npz file: ' + path)
+
+        self.path = path
+        self.chunk_rows = max(1, chunk_rows)
+        self.rows_written = 0
+
+        # The dictionaries, the code of a value is its position in the list
+        self.strings = {}
+        self.usage_types = {}
+        self.sources = {}
+
+        self._parquet_writer = None
+        self._npz_chunks = []
+        self._reset_chunk()
+
+    def _reset_chunk(self):
+        self._time = []
+        self._usage_type = []
+        self._package = []
+        self._class = []
+        self._type = []
+        self._source = []
+
+    @staticmethod
+    def _code(dictionary, value):
+        if value is None:
+            return NO_VALUE
+        code = dictionary.get(value)
+        if code is None:
+            code = dictionary[value] = len(dictionary)
+        return code
+
+    def add(self, usage_type, time, package, class_name, event_type, source):
+        """
+        Add a single row, converting the chunk to columns when it is full.
+        :param usage_type: packages, configurations or event-log
+        :param time: The absolute time in ms since EPOCH, or None
+        :param package: The package name, or None
+        :param class_name: The class name, or None
+        :param event_type: The event type as int, or None
+        :param source: The frequency of the record (daily, weekly, monthly or yearly)
+        """
+        self._time.append(NO_VALUE if time is None else time)
+        self._usage_type.append(self._code(self.usage_types, usage_type))
+        self._package.append(self._code(self.strings, package))
+        self._class.append(self._code(self.strings, class_name))
+        self._type.append(NO_TYPE if event_type is None or not 0 <= event_type < NO_TYPE else event_type)
+        self._source.append(self._code(self.sources, source))
+        if len(self._time) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Convert the collected rows to columns and write them.
+        """
+        if not self._time:
+            return
+        if self.format == FORMAT_PARQUET:
+            self._write_parquet_chunk()
+        else:
+            import numpy as np
+            self._npz_chunks.append((
+                np.array(self._time, dtype=np.int64),
+                np.array(self._usage_type, dtype=np.int32),
+                np.array(self._package, dtype=np.int32),
+                np.array(self._class, dtype=np.int32),
+                np.array(self._type, dtype=np.uint8),
+                np.array(self._source, dtype=np.int32),
+            ))
+        self.rows_written += len(self._time)
+        self._reset_chunk()
+
+    def _write_parquet_chunk(self):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        def without_marker(values, value_type, marker=NO_VALUE):
+            array = pa.array(values, value_type)
+            return pc.if_else(pc.equal(array, marker), pa.scalar(None, value_type), array)
+
+        def dictionary_column(codes, dictionary):
+            return pa.DictionaryArray.from_arrays(without_marker(codes, pa.int32()),
+                                                  pa.array(list(dictionary), pa.string()))
+
+        table = pa.table({
+            'time': without_marker(self._time, pa.int64()),
+            'usage_type': dictionary_column(self._usage_type, self.usage_types),
+            'package': dictionary_column(self._package, self.strings),
+            'class': dictionary_column(self._class, self.strings),
+            'type': without_marker(self._type, pa.uint8(), NO_TYPE),
+            'source': dictionary_column(self._source, self.sources),
+        })
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        """
+        Write the last chunk and close the file.
+        """
+        self.flush()
+        if self.format == FORMAT_PARQUET:
+            if self._parquet_writer is None:
+                # No rows at all, still write a file with the columns
+                self._write_parquet_chunk()
+            self._parquet_writer.close()
+            return
+
+        import numpy as np
+        columns = list(zip(*self._npz_chunks)) if self._npz_chunks else [[]] * 6
+        dtypes = (np.int64, np.int32, np.int32, np.int32, np.uint8, np.int32)
+        time, usage_type, package, class_codes, event_type, source = [
+            np.concatenate(column) if len(column) else np.array([], dtype=dtype)
+            for column, dtype in zip(columns, dtypes)]
+        np.savez_compressed(self.path, time=time, usage_type=usage_type, package=package, **{
+            'class': class_codes,
+            'type': event_type,
+            'source': source,
+            'strings': np.array(list(self.strings), dtype=str),
+            'usage_types': np.array(list(self.usage_types), dtype=str),
+            'sources': np.array(list(self.sources), dtype=str),
+        })
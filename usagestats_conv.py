@@ -1,353 +1,759 @@
 import xml.etree.ElementTree as ET
-import glob, os, sqlite3, os, sys, re, json
-import protobuf.usagestatsservice_pb2 as usagestatsservice_pb2
-from enum import IntEnum
+import glob, os, sqlite3, os, sys, re, json, time, argparse
+import hashlib
+import multiprocessing
+import queue
+import traceback
+from collections import namedtuple
+from usagestats_decoder import iter_usagestats_file, DecodeError, EVENT_TYPE_NAMES
+from usagestats_columnar import ColumnarWriter
+from usagestats_metrics import Metrics, timer, STAGE_READ, STAGE_INSERT, STAGE_REPORT
 
 
-class EventType(IntEnum):
-    NONE = 0
-    MOVE_TO_FOREGROUND = 1
-    MOVE_TO_BACKGROUND = 2
-    END_OF_DAY = 3
-    CONTINUE_PREVIOUS_DAY = 4
-    CONFIGURATION_CHANGE = 5
-    SYSTEM_INTERACTION = 6
-    USER_INTERACTION = 7
-    SHORTCUT_INVOCATION = 8
-    CHOOSER_ACTION = 9
-    NOTIFICATION_SEEN = 10
-    STANDBY_BUCKET_CHANGED = 11
-    NOTIFICATION_INTERRUPTION = 12
-    SLICE_PINNED_PRIV = 13
-    SLICE_PINNED = 14
-    SCREEN_INTERACTIVE = 15
-    SCREEN_NON_INTERACTIVE = 16
-    KEYGUARD_SHOWN = 17
-    KEYGUARD_HIDDEN = 18
+# Default amount of rows buffered before they are flushed to the database in one transaction
+DEFAULT_BATCH_SIZE = 5000
 
-    def __str__(self):
-        return self.name  # This returns 'KNOWN' instead of 'EventType.KNOWN'
+# Allowed values for the sqlite pragmas, these can't be passed as query parameters
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
+# Version of the database layout, stored in the user_version pragma.
+# Databases with another version are rebuilt.
+SCHEMA_VERSION = 3
 
-class EventFlag(IntEnum):
-    FLAG_IS_PACKAGE_INSTANT_APP = 1
+INSERT_DATA = ('INSERT INTO data (id, usage_type, lastime, timeactive, last_time_service_used, last_time_visible, '
+               'total_time_visible, app_launch_count, package_id, types, class_id, source, fullatt, file_id) '
+               'VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)')
 
-    def __str__(self):
-        return self.name
+INSERT_STRING = 'INSERT INTO strings (id, value) VALUES(?,?)'
 
+INSERT_OCCURRENCE = 'INSERT OR IGNORE INTO event_occurrences (data_id, file_id, source) VALUES(?,?,?)'
 
-def read_usage_stats_pb_file(input_path):
-    """Opens file, reads usagestats protobuf and returns IntervalStatsProto object"""
-    stats = usagestatsservice_pb2.IntervalStatsProto()
+# Records that are copied into the daily, weekly, monthly and yearly files, and are stored once in dedup mode.
+# The packages and configurations records hold totals of their own interval, so these differ between the files.
+DEDUP_USAGE_TYPES = ('event-log',)
 
-    with open(input_path, 'rb') as f:
-        stats.ParseFromString(f.read())
-    return stats
+DEDUP_KEYS_QUERY = ('SELECT usage_type, lastime, package_id, class_id, types, id FROM data WHERE usage_type IN (%s)'
+                    % ', '.join("'%s'" % usage_type for usage_type in DEDUP_USAGE_TYPES))
 
+# Positions of the package and class names in a row, these are replaced by their id in the strings table
+ROW_PACKAGE = 7
+ROW_CLASS = 9
 
-def add_entries_to_db(stat_frequency, db):
-    cursor = db.cursor()
-    # packages
-    for usagestat in stat_frequency.packages:
-        finalt = ''
-        if usagestat.HasField('last_time_active_ms'):
-            finalt = usagestat.last_time_active_ms
-            if finalt < 0:
-                finalt = abs(finalt)
-            else:
-                finalt += file_name_int
-        tac = ''
-        if usagestat.HasField('total_time_active_ms'):
-            tac = abs(usagestat.total_time_active_ms)
-        pkg = stat_frequency.stringpool.strings[usagestat.package_index - 1]
-        alc = ''
-        if usagestat.HasField('app_launch_count'):
-            alc = abs(usagestat.app_launch_count)
-
-        datainsert = ('packages', finalt, tac, '', '', '', alc, pkg, '', '', sourced, '')
-        # print(datainsert)
-        cursor.execute(
-            'INSERT INTO data (usage_type, lastime, timeactive, last_time_service_used, last_time_visible, total_time_visible, '
-            'app_launch_count, package, types, classs, source, fullatt)  VALUES(?,?,?,?,?,?,?,?,?,?,?,?)', datainsert)
-    # configurations
-    for conf in stat_frequency.configurations:
-        usagetype = 'configurations'
-        finalt = ''
-        if usagestat.HasField('last_time_active_ms'):
-            finalt = usagestat.last_time_active_ms
-            if finalt < 0:
-                finalt = abs(finalt)
-            else:
-                finalt += file_name_int
-        tac = ''
-        if usagestat.HasField('total_time_active_ms'):
-            tac = abs(usagestat.total_time_active_ms)
-        fullatti_str = str(conf.config)
-        datainsert = (usagetype, finalt, tac, '', '', '', '', '', '', '', stat_frequency, fullatti_str)
-        # print(datainsert)
-        cursor.execute(
-            'INSERT INTO data (usage_type, lastime, timeactive, last_time_service_used, last_time_visible, total_time_visible, '
-            'app_launch_count, package, types, classs, source, fullatt)  VALUES(?,?,?,?,?,?,?,?,?,?,?,?)', datainsert)
-    # event-log
-    usagetype = 'event-log'
-    for event in stat_frequency.event_log:
-        pkg = ''
-        classy = ''
-        tipes = ''
-        finalt = ''
-        if event.HasField('time_ms'):
-            finalt = event.time_ms
-            if finalt < 0:
-                finalt = abs(finalt)
-            else:
-                finalt += file_name_int
-        if event.HasField('package_index'):
-            pkg = stat_frequency.stringpool.strings[event.package_index - 1]
-        if event.HasField('class_index'):
-            classy = stat_frequency.stringpool.strings[event.class_index - 1]
-        if event.HasField('type'):
-            tipes = str(EventType(event.type)) if event.type <= 18 else str(event.type)
-        datainsert = (usagetype, finalt, '', '', '', '', '', pkg, tipes, classy, sourced, '')
-        cursor.execute(
-            'INSERT INTO data (usage_type, lastime, timeactive, last_time_service_used, last_time_visible, total_time_visible, '
-            'app_launch_count, package, types, classs, source, fullatt)  VALUES(?,?,?,?,?,?,?,?,?,?,?,?)', datainsert)
+# Positions of the other values in a row that are part of the columnar export and the dedup key
+ROW_USAGE_TYPE = 0
+ROW_TIME = 1
+ROW_TYPE = 8
+ROW_SOURCE = 10
+ROW_FILE_ID = 12
 
-    db.commit()
+# Size of the chunks read while hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
 
+# Amount of row batches a worker process can have waiting for the writer, before it blocks
+WORKER_QUEUE_BATCHES = 4
+
+# Seconds between the checks whether a worker process is still alive, while the writer waits for its rows
+WORKER_POLL_SECONDS = 1
+
+# Messages sent by the worker processes: a batch of rows of the current file, the end of a file (with its hash
+# and metrics), a file that didn't change since the previous ingest, or the traceback of a crash
+MESSAGE_ROWS = 'rows'
+MESSAGE_DONE = 'done'
+MESSAGE_UNCHANGED = 'unchanged'
+MESSAGE_ERROR = 'error'
+
+# A usagestats file that has to be (re-)ingested. file_id is the id of the file in the manifest table,
+# stored_hash the hash of the previous ingest of the file (or None when it is new).
+IngestTask = namedtuple('IngestTask', ['root', 'filename', 'file_id', 'size', 'mtime', 'stored_hash'])
 
-def create_table():
-    processed = 0
+
+class BatchWriter:
+    """
+    Buffers rows for the data table and writes them with executemany.
+    Every flush is committed as one transaction, so the database is synced once per file (or once per
+    batch_size rows for large files) instead of once per row.
+    Package and class names are replaced by their id in the strings table. This process is the only writer,
+    so the ids are handed out from an in-memory cache, like the ids of the rows.
+
+    In dedup mode a record of DEDUP_USAGE_TYPES is only stored the first time its (usage_type, time, package,
+    class, type) is seen. Every file it appears in is recorded in the event_occurrences table instead.
+    """
+
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE, dedup=False):
+        """
+        :param db: handle to a database
+        :param batch_size: The amount of rows to buffer before they are flushed to the database.
+        :param dedup: Store the records that are copied into several interval files once
+        """
+        self.db = db
+        self.dedup = dedup
+        self.batch_size = max(1, batch_size)
+        self.buffer = []
+        self.occurrences = []
+        self.rows_written = 0
+        self.duplicates = 0
+        self.transactions = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.strings = dict(db.execute('SELECT value, id FROM strings'))
+        self.new_strings = []
+        self.next_id = db.execute('SELECT coalesce(max(id), 0) + 1 FROM data').fetchone()[0]
+        self.seen = {}
+        if dedup:
+            self.load_seen()
+
+    def load_seen(self):
+        """
+        (Re)load the dedup keys of the rows in the database, after rows were removed or added by a previous run.
+        """
+        self.seen = dict((row[:5], row[5]) for row in self.db.execute(DEDUP_KEYS_QUERY))
+
+    def string_id(self, value):
+        """
+        :param value: A package or class name, or None
+        :return: The id of the name in the strings table, or None
+        """
+        if value is None:
+            return None
+        string_id = self.strings.get(value)
+        if string_id is None:
+            string_id = len(self.strings) + 1
+            self.strings[value] = string_id
+            self.new_strings.append((string_id, value))
+        return string_id
+
+    def add(self, values):
+        """
+        Add a single row to the buffer, flushing it when the batch is full.
+        :param values: A tuple with a value for every column in INSERT_DATA except id, with the package and class
+                       names instead of their ids
+        """
+        if self.started is None:
+            self.started = time.perf_counter()
+        package_id = self.string_id(values[ROW_PACKAGE])
+        class_id = self.string_id(values[ROW_CLASS])
+
+        data_id = self.next_id
+        if self.dedup and values[ROW_USAGE_TYPE] in DEDUP_USAGE_TYPES:
+            key = (values[ROW_USAGE_TYPE], values[ROW_TIME], package_id, class_id, values[ROW_TYPE])
+            stored_id = self.seen.get(key)
+            if stored_id is not None:
+                # Stored before from another file, only record that it appeared in this file as well
+                self.duplicates += 1
+                self.occurrences.append((stored_id, values[ROW_FILE_ID], values[ROW_SOURCE]))
+                if len(self.buffer) + len(self.occurrences) >= self.batch_size:
+                    self.flush()
+                return
+            self.seen[key] = data_id
+            self.occurrences.append((data_id, values[ROW_FILE_ID], values[ROW_SOURCE]))
+        self.next_id += 1
+
+        self.buffer.append((data_id,) + values[:ROW_PACKAGE] + (package_id, values[ROW_PACKAGE + 1], class_id) +
+                           values[ROW_CLASS + 1:])
+        if len(self.buffer) + len(self.occurrences) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered rows in one transaction.
+        """
+        if not self.buffer and not self.occurrences:
+            return
+        with self.db:
+            if self.new_strings:
+                self.db.executemany(INSERT_STRING, self.new_strings)
+                self.new_strings = []
+            self.db.executemany(INSERT_DATA, self.buffer)
+            self.db.executemany(INSERT_OCCURRENCE, self.occurrences)
+        self.rows_written += len(self.buffer)
+        self.transactions += 1
+        self.buffer = []
+        self.occurrences = []
+        self.elapsed = time.perf_counter() - self.started
+
+    def rows_per_sec(self):
+        """
+        :return: The amount of rows written per second since the first row was added.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.rows_written / self.elapsed
+
+
+def create_table(db_path='usagestats.db', journal_mode='WAL', synchronous='NORMAL', rebuild=False):
+    """
+    Create (or open) the database with the data and manifest tables.
+    :param db_path: The path of the sqlite database to create
+    :param journal_mode: The sqlite journal_mode pragma, one of JOURNAL_MODES
+    :param synchronous: The sqlite synchronous pragma, one of SYNCHRONOUS_MODES
+    :param rebuild: Drop everything that was ingested by a previous run
+    :return: A handle to the database and a cursor
+    """
+    journal_mode = journal_mode.upper()
+    synchronous = synchronous.upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError('Unknown journal_mode: ' + journal_mode)
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError('Unknown synchronous mode: ' + synchronous)
 
     # Create sqlite databases
-    db = sqlite3.connect('usagestats.db')
+    db = sqlite3.connect(db_path)
     cursor = db.cursor()
 
+    # Fewer fsyncs while ingesting, the database can be rebuilt from the source files anyway
+    cursor.execute('PRAGMA journal_mode=' + journal_mode)
+    cursor.execute('PRAGMA synchronous=' + synchronous)
+
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    tables = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    if 'data' in tables and version != SCHEMA_VERSION and not rebuild:
+        print('Database ' + db_path + ' was created by another version, rebuilding it')
+        rebuild = True
+
+    if rebuild:
+        cursor.execute('DROP VIEW IF EXISTS data_view')
+        cursor.execute('DROP TABLE IF EXISTS data')
+        cursor.execute('DROP TABLE IF EXISTS event_occurrences')
+        cursor.execute('DROP TABLE IF EXISTS strings')
+        cursor.execute('DROP TABLE IF EXISTS manifest')
+        cursor.execute('DROP TABLE IF EXISTS aggregate_cache')
+
     # Create table usagedata.
+    # Times are in ms since EPOCH and missing values are NULL. Event types are stored as their number and
+    # package and class names as an id in the strings table, like the stringpool of the protobuf files.
 
     cursor.execute('''
 
-           CREATE TABLE data(usage_type TEXT, lastime INTEGER, timeactive INTEGER,
+           CREATE TABLE IF NOT EXISTS data(id INTEGER PRIMARY KEY, usage_type TEXT, lastime INTEGER, timeactive INTEGER,
                              last_time_service_used INTEGER, last_time_visible INTEGER, total_time_visible INTEGER,
                              app_launch_count INTEGER,
-                             package TEXT, types TEXT, classs TEXT,
-                             source TEXT, fullatt TEXT)
+                             package_id INTEGER REFERENCES strings (id), types INTEGER,
+                             class_id INTEGER REFERENCES strings (id),
+                             source TEXT, fullatt TEXT, file_id INTEGER)
 
        ''')
 
-    db.commit()
-    return db, cursor
+    cursor.execute('''
 
+           CREATE TABLE IF NOT EXISTS strings(id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)
 
-def parse_file_with_protobuf(path_to_file, db):
-    """
-    Try to parse the usagestats file with a protobuf.
-    Credits for protobuf support goes to Yogesh Khatri, see the readme for the blogpost
-    :param path_to_file: The path to the file (including the file) to be parsed.
-    :param db: The database to write the results to
-    :return:
-    """
-    stats = None
-    # Perhaps an Android Q protobuf file
-    try:
-        stats = read_usage_stats_pb_file(path_to_file)
+       ''')
 
-    except:
-        print('Parse error - Non XML and Non Protobuf file? at: ' + path_to_file)
+    # The files every row of DEDUP_USAGE_TYPES appeared in, when it was ingested in dedup mode
+    cursor.execute('''
 
-    add_entries_to_db(stats, db)
+           CREATE TABLE IF NOT EXISTS event_occurrences(data_id INTEGER REFERENCES data (id),
+                                                        file_id INTEGER REFERENCES manifest (id), source TEXT,
+                                                        PRIMARY KEY (data_id, file_id)) WITHOUT ROWID
 
+       ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS event_occurrences_file_id ON event_occurrences (file_id)')
 
-def calc_last_time_active(xml_element, filename):
-    """
-    Calculate the absolute time (in EPOCH) when an event was active for the last time.
-    :param xml_element: The element containing an lastTimeActive attribute
-    :param filename: A filename where the name contains digits only, representing the creation time in EPOCH.
-    :return: The EPOCH representation of the time an event was active for the last time.
-    """
-    if 'lastTimeActive' in xml_element.keys():
-        relative_last_time_active = int(xml_element.attrib['lastTimeActive'])
+    # The data table with the package and class names resolved.
+    # intervals lists the frequencies a deduplicated row appeared in, and is NULL for the other rows.
+    cursor.execute('''
 
-        # Some events show the last_time_active as EPOCH already, which is indicated by starting with a minus sign
-        if relative_last_time_active < 0:
-            last_time_active = abs(relative_last_time_active)
+           CREATE VIEW IF NOT EXISTS data_view AS
+           SELECT data.*, package.value AS package, class.value AS classs,
+                  (SELECT group_concat(DISTINCT source) FROM event_occurrences WHERE data_id = data.id) AS intervals
+           FROM data
+           LEFT JOIN strings AS package ON package.id = data.package_id
+           LEFT JOIN strings AS class ON class.id = data.class_id
 
-        # Otherwise we need to add the filename (which is the start time in EPOCH)
-        # to the relative time (represented in ms)
-        else:
-            last_time_active = int(filename) + relative_last_time_active
-        return last_time_active
+       ''')
 
-    else:
-        return ''
+    # Timeline queries are range scans on these indexes
+    cursor.execute('CREATE INDEX IF NOT EXISTS data_lastime ON data (lastime)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS data_package_lastime ON data (package_id, lastime)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS data_usage_type ON data (usage_type)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS data_file_id ON data (file_id)')
 
+    # Every ingested usagestats file, so a re-run only has to parse new or changed files.
+    # The path is relative to the parsed usagestats directory.
+    cursor.execute('''
 
-def parse_sub_elements(frequency, xml_element, filename, db):
-    """
-    Parse all childs of the <packages> element.
-    Example how a child element looks like:
-        <package lastTimeActive="-1589192784125"  package="com.samsung.android.provider.filterprovider"
-            timeActive="0" lastEvent="0" />
+           CREATE TABLE IF NOT EXISTS manifest(id INTEGER PRIMARY KEY, path TEXT UNIQUE,
+                                               size INTEGER, mtime REAL, hash TEXT)
 
-    And store them in the database
-    :param frequency: The frequency of usagestats record (daily, weekly, monthly or yearly)
-    :param xml_element: the element <packages> containing all its childs
-    :param filename: The filename being parsed, already checked if it only contains numbers.
-                    This represents an EPOCH timestamp
-    :param db: handle to a database
-    :return:
-    """
-    for child in xml_element:
-        all_attributes = json.dumps(child.attrib)
-        usage_type = xml_element.tag
-        # If the attribute exists in this xml element, fetch its value. Otherwise set to ''
-        last_active_time = calc_last_time_active(child, filename)
-        package = child.attrib.get('package', '')
-        time_active = child.attrib.get('timeActive', '')
-        app_launch = child.attrib.get('appLaunchCount', '')
-        type_class = child.attrib.get('class', '')
-        type_type = child.attrib.get('type', '')
-
-        values = (usage_type, last_active_time, time_active, '', '', '', app_launch, package,
-                  type_type, type_class, frequency, all_attributes)
-        cursor = db.cursor()
-        cursor.execute(
-            'INSERT INTO data (usage_type, lastime, timeactive, last_time_service_used, last_time_visible, total_time_visible, '
-            'app_launch_count, package, types, classs, source, fullatt)  VALUES(?,?,?,?,?,?,?,?,?,?,?,?)',
-            values)
-        db.commit()
-
-
-def usagestats_parse(dirpath):
-    """
-    Parse every usagestat file, based on an input directory
-    :param dirpath: string to file to parse
-    :return:
-    """
-    # Create database
-    # TODO: change to an easier format, probably json.
-    db, cursor = create_table()
+       ''')
 
-    # Some vars for logging
-    processed = 0
-    err = 0
+    cursor.execute('PRAGMA user_version=' + str(SCHEMA_VERSION))
+    db.commit()
+    return db, cursor
 
-    # Iterate through the /usagestats/ directory and fetch all files
-    for root, dirnames, filenames in os.walk(dirpath, topdown=True, onerror=None, followlinks=False):
-        if 'daily' in root or 'weekly' in root or 'monthly' in root or 'yearly' in root:
-            # Retrieve the folder name to save what the frequency of the usagestats were:
-            frequency = root.split('/')[-1]
-            for filename in filenames:
-                # Check if filename is only numbers (which is an epoch time representation)
-                if filename.isnumeric():
-                    try:
-                        tree = ET.parse(os.path.join(root, filename))
-                    except ET.ParseError:
-                        parse_file_with_protobuf(os.path.join(root, filename), db)
-                        continue
 
-                    # We have sucessfully parsed the usagestats xml.
-                    # So continue processing
-                    tree_root = tree.getroot()
+def record_to_row(record, frequency, file_id):
+    """
+    Convert a record of an usagestats file (XML or protobuf) to a row of the data table.
+    :param record: A usagestats_xml.UsageRecord
+    :param frequency: The frequency of usagestats record (daily, weekly, monthly or yearly)
+    :param file_id: The id of the file in the manifest table
+    :return: A tuple with a value for every column in INSERT_DATA except id, with the package and class names
+             instead of their ids
+    """
+    all_attributes = json.dumps(record.attributes)
+    # Values missing from the record are stored as NULL
+    return (record.usage_type, record.time, record.time_active, None, None, None,
+            record.app_launch_count, record.package, record.type,
+            record.class_name, frequency, all_attributes, file_id)
+
 
-                    for elem in tree_root:
-                        parse_sub_elements(frequency, elem, filename, db)
+# Amount of report rows that are collected before they are written to the report in one go
+REPORT_CHUNK_ROWS = 1000
 
-        # query for reporting
-        cursor.execute('''
+REPORT_QUERY = '''
         select 
         usage_type,
         datetime(lastime/1000, 'UNIXEPOCH', 'localtime') as lasttimeactive,
         timeactive as time_Active_in_msecs,
         timeactive/1000 as timeactive_in_secs,
-        case last_time_service_used  WHEN '' THEN ''
-         ELSE datetime(last_time_service_used/1000, 'UNIXEPOCH', 'localtime')
-        end last_time_service_used,
-        case last_time_visible  WHEN '' THEN ''
-         ELSE datetime(last_time_visible/1000, 'UNIXEPOCH', 'localtime') 
-        end last_time_visible,
+        datetime(last_time_service_used/1000, 'UNIXEPOCH', 'localtime') as last_time_service_used,
+        datetime(last_time_visible/1000, 'UNIXEPOCH', 'localtime') as last_time_visible,
         total_time_visible,
         app_launch_count,
         package,
         CASE types
-             WHEN '1' THEN 'MOVE_TO_FOREGROUND'
-             WHEN '2' THEN 'MOVE_TO_BACKGROUND'
-             WHEN '5' THEN 'CONFIGURATION_CHANGE'
-             WHEN '7' THEN 'USER_INTERACTION'
-             WHEN '8' THEN 'SHORTCUT_INVOCATION'
+%s
              ELSE types
         END types,
         classs,
-        source,
+        coalesce(intervals, source) as source,
         fullatt
+        from data_view
+        order by lastime DESC
+        ''' % '\n'.join("             WHEN %d THEN '%s'" % item for item in enumerate(EVENT_TYPE_NAMES))
+
+# The columns of the columnar export, in the order of the rows
+EXPORT_QUERY = '''
+        select data.usage_type, data.lastime, package.value, class.value, data.types, data.source
         from data
-        order by lasttimeactive DESC
-        ''')
-        all_rows = cursor.fetchall()
-
-        # HTML report section
-        h = open('./Report.html', 'w')
-        h.write('<html><body>')
-        h.write('<h2>Android Usagestats report (Dates are localtime!)</h2>')
-        h.write('<style> table, th, td {border: 1px solid black; border-collapse: collapse;}</style>')
-        h.write('<br />')
-
-        # HTML headers
-        h.write('<table>')
-        h.write('<tr>')
-        h.write('<th>Usage Type</th>')
-        h.write('<th>Last Time Active</th>')
-        h.write('<th>Time Active in Msecs</th>')
-        h.write('<th>Time Active in Secs</th>')
-        h.write('<th>Last Time Service Used</th>')
-        h.write('<th>Last Time Visible</th>')
-        h.write('<th>Total Time Visible</th>')
-        h.write('<th>App Launch Count</th>')
-        h.write('<th>Package</th>')
-        h.write('<th>Types</th>')
-        h.write('<th>Class</th>')
-        h.write('<th>Source</th>')
-        h.write('</tr>')
-
-        for row in all_rows:
-            usage_type = row[0]
-            lasttimeactive = row[1]
-            time_Active_in_msecs = row[2]
-            timeactive_in_secs = row[3]
-            last_time_service_used = row[4]
-            last_time_visible = row[5]
-            total_time_visible = row[6]
-            app_launch_count = row[7]
-            package = row[8]
-            types = row[9]
-            classs = row[10]
-            source = row[11]
+        left join strings as package on package.id = data.package_id
+        left join strings as class on class.id = data.class_id
+        order by data.id
+        '''
+
+REPORT_HEADER = (
+    '<html><body>'
+    '<h2>Android Usagestats report (Dates are localtime!)</h2>'
+    '<style> table, th, td {border: 1px solid black; border-collapse: collapse;}</style>'
+    '<br />'
+    '<table>'
+    '<tr>'
+    '<th>Usage Type</th>'
+    '<th>Last Time Active</th>'
+    '<th>Time Active in Msecs</th>'
+    '<th>Time Active in Secs</th>'
+    '<th>Last Time Service Used</th>'
+    '<th>Last Time Visible</th>'
+    '<th>Total Time Visible</th>'
+    '<th>App Launch Count</th>'
+    '<th>Package</th>'
+    '<th>Types</th>'
+    '<th>Class</th>'
+    '<th>Source</th>'
+    '</tr>'
+)
+
+REPORT_FOOTER = '</table><br /></body></html>'
+
+
+def iter_usagestats_files(dirpath):
+    """
+    Find every usagestats file, based on an input directory
+    :param dirpath: The usagestats directory to search
+    :return: A generator of (directory, filename) tuples
+    """
+    # Iterate through the /usagestats/ directory and fetch all files
+    for root, dirnames, filenames in os.walk(dirpath, topdown=True, onerror=None, followlinks=False):
+        if 'daily' in root or 'weekly' in root or 'monthly' in root or 'yearly' in root:
+            for filename in filenames:
+                # Check if filename is only numbers (which is an epoch time representation)
+                if filename.isnumeric():
+                    yield root, filename
+
+
+def file_hash(path):
+    """
+    :param path: The path of the file to hash
+    :return: The SHA-256 of the file, as hex
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def plan_ingest(db, dirpath):
+    """
+    Compare the usagestats files with the manifest of a previous run.
+    Files with the same size and mtime as in the manifest are skipped without reading them.
+    New files are added to the manifest, so their rows can be linked to it.
+    :param db: handle to a database
+    :param dirpath: The usagestats directory to search
+    :return: A list of IngestTask for the new and (possibly) changed files, and the amount of skipped files
+    """
+    manifest = {}
+    for file_id, path, size, mtime, stored_hash in db.execute('SELECT id, path, size, mtime, hash FROM manifest'):
+        manifest[path] = (file_id, size, mtime, stored_hash)
+
+    tasks = []
+    skipped = 0
+    for root, filename in iter_usagestats_files(dirpath):
+        stat = os.stat(os.path.join(root, filename))
+        relative_path = os.path.relpath(os.path.join(root, filename), dirpath)
+        if relative_path in manifest:
+            file_id, size, mtime, stored_hash = manifest[relative_path]
+            if size == stat.st_size and mtime == stat.st_mtime:
+                skipped += 1
+                continue
+        else:
+            file_id = db.execute('INSERT INTO manifest (path) VALUES (?)', (relative_path,)).lastrowid
+            stored_hash = None
+        tasks.append(IngestTask(root, filename, file_id, stat.st_size, stat.st_mtime, stored_hash))
+    db.commit()
+    return tasks, skipped
+
+
+def parse_usagestats_file(root, filename, writer, file_id, metrics=None):
+    """
+    Parse a single usagestats file, either XML or protobuf.
+    :param root: The directory of the file, named after the frequency of the usagestats records
+    :param filename: The filename being parsed, already checked if it only contains numbers.
+    :param writer: The BatchWriter (or RowBatch) to write the results to
+    :param file_id: The id of the file in the manifest table
+    :param metrics: An optional usagestats_metrics.Metrics for the stages of the file
+    :return:
+    """
+    # Retrieve the folder name to save what the frequency of the usagestats were:
+    frequency = root.split('/')[-1]
+    path = os.path.join(root, filename)
+    stored = 0
+    try:
+        for record in iter_usagestats_file(path, filename, metrics):
+            writer.add(record_to_row(record, frequency, file_id))
+            stored += 1
+    except (ET.ParseError, DecodeError):
+        if stored:
+            # A truncated (carved) file still holds evidence, keep the records parsed so far
+            print('Parse error - Truncated file? at: ' + path)
+        else:
+            print('Parse error - Non XML and Non Protobuf file? at: ' + path)
+
+
+class RowBatch:
+    """
+    Collects the rows of a file in a worker process and sends them to the writer in batches of batch_size rows.
+    The queue is bounded, so a worker waits for the writer instead of holding the rows of a whole file.
+    """
+
+    def __init__(self, queue, batch_size=DEFAULT_BATCH_SIZE):
+        self.queue = queue
+        self.batch_size = max(1, batch_size)
+        self.rows = []
+
+    def add(self, values):
+        self.rows.append(values)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.queue.put((MESSAGE_ROWS, self.rows))
+            self.rows = []
 
+
+def parse_usagestats_worker(tasks, queue, batch_size):
+    """
+    Entry point for the worker processes of the parallel mode, parses its files in order.
+    For every file it sends MESSAGE_ROWS batches followed by MESSAGE_DONE, or only MESSAGE_UNCHANGED,
+    both with the hash and the Metrics of the file.
+    :param tasks: The IngestTasks of this worker, as returned by plan_ingest
+    :param queue: The bounded queue to the writer
+    :param batch_size: The amount of rows sent at once
+    """
+    try:
+        for task in tasks:
+            metrics = Metrics()
+            with metrics.timed(STAGE_READ, size=task.size):
+                digest = file_hash(os.path.join(task.root, task.filename))
+            if digest == task.stored_hash:
+                queue.put((MESSAGE_UNCHANGED, digest, metrics))
+                continue
+            rows = RowBatch(queue, batch_size)
+            parse_usagestats_file(task.root, task.filename, rows, task.file_id, metrics)
+            rows.flush()
+            queue.put((MESSAGE_DONE, digest, metrics))
+    except Exception:
+        queue.put((MESSAGE_ERROR, traceback.format_exc()))
+
+
+def start_file(db, writer, task):
+    """
+    Remove the rows of a previous ingest of a file, before it is ingested again.
+    This is part of the same transaction as the new rows of the file.
+    A file without hash in the manifest can still have rows: large files are committed every batch_size rows,
+    so an interrupted ingest leaves the rows of its last file behind. These are always removed, a new file has none.
+    Deduplicated rows that appeared in other files as well are kept, and are linked to one of those files instead.
+    """
+    removed = db.execute('DELETE FROM event_occurrences WHERE file_id = ?', (task.file_id,)).rowcount
+    if writer.dedup:
+        # Forget the keys of the rows that are removed, the keys of the other files stay as they are
+        for row in db.execute(DEDUP_KEYS_QUERY + ' AND file_id = ? AND id NOT IN (SELECT data_id FROM '
+                              'event_occurrences)', (task.file_id,)).fetchall():
+            if writer.seen.get(row[:5]) == row[5]:
+                del writer.seen[row[:5]]
+    removed += db.execute('DELETE FROM data WHERE file_id = ? AND id NOT IN (SELECT data_id FROM event_occurrences)',
+                          (task.file_id,)).rowcount
+    if not removed:
+        return
+    db.execute('UPDATE data SET (file_id, source) = (SELECT file_id, source FROM event_occurrences '
+               'WHERE data_id = data.id ORDER BY file_id LIMIT 1) WHERE file_id = ?', (task.file_id,))
+
+
+def finish_file(db, writer, task, digest):
+    """
+    Record a file in the manifest and commit everything written for it.
+    """
+    db.execute('UPDATE manifest SET size = ?, mtime = ?, hash = ? WHERE id = ?',
+               (task.size, task.mtime, digest, task.file_id))
+    # One transaction per file
+    writer.flush()
+    db.commit()
+
+
+def write_report(db, report_path='./Report.html'):
+    """
+    Write the HTML report of everything in the data table.
+    Rows are streamed from the cursor and written in chunks of REPORT_CHUNK_ROWS,
+    so memory use does not grow with the amount of rows in the database.
+    :param db: handle to a database
+    :param report_path: The path of the HTML report to write
+    :return: The amount of rows written to the report
+    """
+    processed = 0
+    cursor = db.cursor()
+    cursor.execute(REPORT_QUERY)
+
+    with open(report_path, 'w') as h:
+        h.write(REPORT_HEADER)
+
+        chunk = []
+        for row in cursor:
             processed = processed + 1
-            # report data
-            h.write('<tr>')
-            h.write('<td>' + str(usage_type) + '</td>')
-            h.write('<td>' + str(lasttimeactive) + '</td>')
-            h.write('<td>' + str(time_Active_in_msecs) + '</td>')
-            h.write('<td>' + str(timeactive_in_secs) + '</td>')
-            h.write('<td>' + str(last_time_service_used) + '</td>')
-            h.write('<td>' + str(last_time_visible) + '</td>')
-            h.write('<td>' + str(total_time_visible) + '</td>')
-            h.write('<td>' + str(app_launch_count) + '</td>')
-            h.write('<td>' + str(package) + '</td>')
-            h.write('<td>' + str(types) + '</td>')
-            h.write('<td>' + str(classs) + '</td>')
-            h.write('<td>' + str(source) + '</td>')
-            h.write('</tr>')
-
-        # HTML footer
-        h.write('<table>')
-        h.write('<br />')
-
-        print('')
-        print('Records processed: ' + str(processed))
-        print('Triage report completed. See Reports.html.')
+            # report data, the last column (fullatt) isn't part of the report
+            chunk.append('<tr><td>' + '</td><td>'.join('' if value is None else str(value) for value in row[:12]) +
+                         '</td></tr>')
+            if len(chunk) >= REPORT_CHUNK_ROWS:
+                h.write(''.join(chunk))
+                chunk = []
+        h.write(''.join(chunk))
+
+        h.write(REPORT_FOOTER)
+
+    return processed
+
+
+def export_columnar(db, exporter):
+    """
+    Export every row of the data table, not only the rows of the files ingested by this run.
+    The rows are streamed from the cursor and converted to columns one chunk at a time.
+    :param db: handle to a database
+    :param exporter: The usagestats_columnar.ColumnarWriter to write to, it is closed afterwards
+    :return: The amount of rows exported
+    """
+    for row in db.execute(EXPORT_QUERY):
+        exporter.add(*row)
+    exporter.close()
+    return exporter.rows_written
+
+
+def ingest_directory(db, writer, dirpath, jobs=1, metrics=None):
+    """
+    Ingest every new or changed usagestats file of a directory.
+    :param db: handle to a database
+    :param writer: The BatchWriter to write the rows to
+    :param dirpath: The usagestats directory to parse
+    :param jobs: The amount of worker processes parsing files, 1 parses everything in this process
+    :param metrics: An optional usagestats_metrics.Metrics that gets the stages of every file
+    :return: The amount of files ingested and the amount of files that didn't change since the last run
+    """
+    if metrics is None:
+        metrics = Metrics()
+    tasks, skipped = plan_ingest(db, dirpath)
+    unchanged = 0
+
+    if jobs > 1:
+        # Parse in worker processes, this process is the single writer of the database.
+        # The files are divided round robin over the workers and every worker has its own bounded queue.
+        # The writer reads the queues in the same order as the files are walked, so the rows end up in the database
+        # in the same order as in the serial mode, and at most WORKER_QUEUE_BATCHES batches per worker are waiting.
+        queues = [multiprocessing.Queue(WORKER_QUEUE_BATCHES) for _ in range(jobs)]
+        workers = [multiprocessing.Process(target=parse_usagestats_worker,
+                                           args=(tasks[number::jobs], queues[number], writer.batch_size))
+                   for number in range(jobs)]
+        for worker in workers:
+            worker.start()
+        try:
+            for index, task in enumerate(tasks):
+                worker_queue = queues[index % jobs]
+                worker = workers[index % jobs]
+                inserting = 0.0
+                rows = 0
+                started_file = False
+                while True:
+                    try:
+                        message = worker_queue.get(timeout=WORKER_POLL_SECONDS)
+                    except queue.Empty:
+                        # Killed (like by the OOM killer) or crashed without sending an error
+                        if not worker.is_alive() and worker_queue.empty():
+                            raise RuntimeError('Worker process died with exit code %s' % worker.exitcode)
+                        continue
+                    if message[0] == MESSAGE_ERROR:
+                        raise RuntimeError('Worker process failed:\n' + message[1])
+                    started = timer()
+                    if message[0] != MESSAGE_ROWS:
+                        break
+                    if not started_file:
+                        start_file(db, writer, task)
+                        started_file = True
+                    for values in message[1]:
+                        writer.add(values)
+                    rows += len(message[1])
+                    inserting += timer() - started
+
+                kind, digest, file_metrics = message
+                if kind == MESSAGE_UNCHANGED:
+                    unchanged += 1
+                elif not started_file:
+                    start_file(db, writer, task)
+                finish_file(db, writer, task, digest)
+                file_metrics.add(STAGE_INSERT, inserting + timer() - started, rows=rows)
+                metrics.add_file(os.path.join(task.root, task.filename), file_metrics.total(), file_metrics,
+                                 task.size)
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+    else:
+        for task in tasks:
+            file_metrics = Metrics()
+            started = timer()
+            with file_metrics.timed(STAGE_READ, size=task.size):
+                digest = file_hash(os.path.join(task.root, task.filename))
+            if digest == task.stored_hash:
+                unchanged += 1
+            else:
+                start_file(db, writer, task)
+                parse_usagestats_file(task.root, task.filename, writer, task.file_id, file_metrics)
+            finish_file(db, writer, task, digest)
+            seconds = timer() - started
+            # The rest of the time of the file went to converting, buffering and writing the rows
+            file_metrics.add(STAGE_INSERT, seconds - file_metrics.total(), rows=file_metrics.record_rows())
+            metrics.add_file(os.path.join(task.root, task.filename), seconds, file_metrics, task.size)
+
+    return len(tasks) - unchanged, skipped + unchanged
+
+
+def usagestats_parse(dirpath, db_path='usagestats.db', batch_size=DEFAULT_BATCH_SIZE,
+                     journal_mode='WAL', synchronous='NORMAL', report_path='./Report.html', jobs=1, rebuild=False,
+                     columnar_path=None, dedup=False, metrics_path=None):
+    """
+    Parse every usagestat file, based on an input directory
+    :param dirpath: string to file to parse
+    :param db_path: The path of the sqlite database to create
+    :param batch_size: The amount of rows to buffer before they are written in one transaction
+    :param journal_mode: The sqlite journal_mode pragma
+    :param synchronous: The sqlite synchronous pragma
+    :param report_path: The path of the HTML report to write
+    :param jobs: The amount of worker processes parsing files, 1 parses everything in this process
+    :param rebuild: Parse every file again, instead of only the files that are new or changed since the last run
+    :param columnar_path: Also export every row of the database to this .parquet or .npz file
+    :param dedup: Store the events that are copied into the daily, weekly, monthly and yearly files once,
+                  with the intervals they appeared in
+    :param metrics_path: Also write the summary of the stages to this JSON file
+    :return: The usagestats_metrics.Metrics of the run
+    """
+    # Create database
+    # TODO: change to an easier format, probably json.
+    db, cursor = create_table(db_path, journal_mode, synchronous, rebuild)
+    # Created up front, so a missing pyarrow or numpy is reported before the files are parsed
+    exporter = ColumnarWriter(columnar_path) if columnar_path else None
+    writer = BatchWriter(db, batch_size, dedup)
+    metrics = Metrics()
+
+    ingested, unchanged = ingest_directory(db, writer, dirpath, jobs, metrics)
+
+    print('')
+    print('Files ingested: ' + str(ingested) + ', unchanged: ' + str(unchanged))
+    print('Rows written: ' + str(writer.rows_written) + ' in ' + str(writer.transactions) +
+          ' transactions (' + str(round(writer.rows_per_sec())) + ' rows/sec)')
+    if dedup:
+        print('Duplicate records skipped: ' + str(writer.duplicates))
+    if exporter is not None:
+        print('Rows exported: ' + str(export_columnar(db, exporter)) + ' to ' + columnar_path)
+
+    # Reporting only starts once every file has been ingested
+    started = timer()
+    processed = write_report(db, report_path)
+    metrics.add(STAGE_REPORT, timer() - started, processed, os.path.getsize(report_path))
+    db.close()
+
+    print('Records processed: ' + str(processed))
+    print('Triage report completed. See ' + report_path + '.')
+
+    # Machine-readable summary of the run, as the last line of the output
+    summary = metrics.to_json(ingested=ingested, unchanged=unchanged, rows_written=writer.rows_written,
+                              transactions=writer.transactions, duplicates=writer.duplicates, jobs=jobs)
+    if metrics_path:
+        with open(metrics_path, 'w') as f:
+            f.write(summary + '\n')
+    print('Metrics: ' + summary)
+    return metrics
 
 
 if __name__ == '__main__':
-    # For testing purposes, use script directory
-    usagestats_parse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usagestats'))
+    parser = argparse.ArgumentParser(description='Parse Android usagestats files into a sqlite database and report.')
+    # For testing purposes, default to the script directory
+    parser.add_argument('dirpath', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usagestats'),
+                        help='The usagestats directory to parse')
+    parser.add_argument('--db', default='usagestats.db', help='The sqlite database to write to')
+    parser.add_argument('--report', default='./Report.html', help='The HTML report to write')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Amount of worker processes parsing files, the database has a single writer')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Parse every file again, instead of only the files that are new or changed')
+    parser.add_argument('--columnar', metavar='PATH',
+                        help='Also export every row of the database (not only the rows of the files that are new or '
+                             'changed) to a columnar .parquet (needs pyarrow) or .npz (needs numpy) file')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Store the events that are copied into the daily, weekly, monthly and yearly files once, '
+                             'with the intervals they appeared in')
+    parser.add_argument('--metrics', metavar='PATH', help='Also write the metrics of the stages to this JSON file')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Profile the run with cProfile and write the stats to this file (see pstats), '
+                             'the worker processes of --jobs are not profiled')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Amount of rows written per transaction')
+    parser.add_argument('--journal-mode', default='WAL', choices=JOURNAL_MODES, type=str.upper,
+                        help='The sqlite journal_mode pragma')
+    parser.add_argument('--synchronous', default='NORMAL', choices=SYNCHRONOUS_MODES, type=str.upper,
+                        help='The sqlite synchronous pragma')
+    args = parser.parse_args()
+
+    run_args = (args.dirpath, args.db, args.batch_size, args.journal_mode, args.synchronous, args.report,
+                args.jobs, args.rebuild, args.columnar, args.dedup, args.metrics)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(usagestats_parse, *run_args)
+        finally:
+            profiler.dump_stats(args.profile)
+            print('Profile written to ' + args.profile)
+    else:
+        usagestats_parse(*run_args)
@@ -0,0 +1,220 @@
+"""
+Generate a synthetic usagestats directory, to benchmark the tools without a real device extraction.
+
+The tree looks like /data/system/usagestats/ of a device: daily, weekly, monthly and yearly directories with files
+named after their start time in EPOCH (ms). The files are either XML (Android 9 and older) or IntervalStatsProto
+protobuf (Android 10+) files, with packages, configurations and an event log.
+"""
+import argparse
+import os
+import random
+from xml.sax.saxutils import quoteattr
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Length of the intervals of the files in every directory
+INTERVALS = (
+    ('daily', DAY_MS),
+    ('weekly', 7 * DAY_MS),
+    ('monthly', 30 * DAY_MS),
+    ('yearly', 365 * DAY_MS),
+)
+
+# Start of the generated usagestats: 2020-05-10 00:00:00 UTC
+DEFAULT_START_MS = 1589068800000
+
+# Event types used for the generated event log
+MOVE_TO_FOREGROUND = 1
+MOVE_TO_BACKGROUND = 2
+SCREEN_INTERACTIVE = 15
+SCREEN_NON_INTERACTIVE = 16
+
+
+def _varint(value):
+    if value < 0:
+        # int32 and int64 fields are encoded as 64 bit two's complement
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _varint_field(field, value):
+    return _varint(field << 3) + _varint(value)
+
+
+def _bytes_field(field, value):
+    return _varint(field << 3 | 2) + _varint(len(value)) + value
+
+
+def generate_interval(rng, interval_ms, packages, events):
+    """
+    Generate the content of a single interval file.
+    :param rng: A random.Random
+    :param interval_ms: The length of the interval
+    :param packages: The package names to use
+    :param events: The amount of events in the event log
+    :return: A dict with the packages, configurations and events, times are relative to the start of the file
+    """
+    package_stats = []
+    for package in packages:
+        package_stats.append({
+            'package': package,
+            'last_time_active_ms': rng.randrange(interval_ms),
+            'total_time_active_ms': rng.randrange(60 * 60 * 1000),
+            'app_launch_count': rng.randrange(50),
+        })
+
+    configurations = [{
+        'last_time_active_ms': rng.randrange(interval_ms),
+        'total_time_active_ms': rng.randrange(interval_ms),
+        'count': rng.randrange(1, 10),
+    }]
+
+    # Sessions of an app in the foreground, with the screen turning on and off every now and then
+    event_log = []
+    time = 0
+    step = max(1, interval_ms // max(1, events))
+    while len(event_log) < events:
+        if rng.random() < 0.1:
+            event_log.append({'time_ms': time, 'package': 'android', 'type': SCREEN_INTERACTIVE})
+            event_log.append({'time_ms': time + step // 4, 'package': 'android', 'type': SCREEN_NON_INTERACTIVE})
+        else:
+            package = rng.choice(packages)
+            event_log.append({'time_ms': time, 'package': package, 'class': package + '.MainActivity',
+                              'type': MOVE_TO_FOREGROUND})
+            event_log.append({'time_ms': time + rng.randrange(1, max(2, step)), 'package': package,
+                              'class': package + '.MainActivity', 'type': MOVE_TO_BACKGROUND})
+        time += step
+    del event_log[events:]
+
+    return {'packages': package_stats, 'configurations': configurations, 'event_log': event_log}
+
+
+def to_xml(interval, interval_ms):
+    """
+    :return: The interval as XML usagestats file
+    """
+    lines = ["<?xml version='1.0' encoding='utf-8' standalone='yes' ?>",
+             '<usagestats version="1" endTime="%d">' % interval_ms,
+             '<packages>']
+    for stats in interval['packages']:
+        lines.append('<package lastTimeActive="%d" package=%s timeActive="%d" lastEvent="%d" appLaunchCount="%d" />'
+                     % (stats['last_time_active_ms'], quoteattr(stats['package']), stats['total_time_active_ms'],
+                        MOVE_TO_BACKGROUND, stats['app_launch_count']))
+    lines.append('</packages>')
+    lines.append('<configurations>')
+    for configuration in interval['configurations']:
+        lines.append('<config lastTimeActive="%d" timeActive="%d" count="%d" fs="1100" locales="en-US" />'
+                     % (configuration['last_time_active_ms'], configuration['total_time_active_ms'],
+                        configuration['count']))
+    lines.append('</configurations>')
+    lines.append('<event-log>')
+    for event in interval['event_log']:
+        class_attribute = ' class=%s' % quoteattr(event['class']) if 'class' in event else ''
+        lines.append('<event time="%d" package=%s%s type="%d" />'
+                     % (event['time_ms'], quoteattr(event['package']), class_attribute, event['type']))
+    lines.append('</event-log>')
+    lines.append('</usagestats>')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def to_protobuf(interval, interval_ms):
+    """
+    :return: The interval as IntervalStatsProto usagestats file, with the names in the stringpool
+    """
+    strings = []
+    indexes = {}
+
+    def string_index(value):
+        # Indexes in the stringpool start at 1
+        if value not in indexes:
+            strings.append(value)
+            indexes[value] = len(strings)
+        return indexes[value]
+
+    body = [_varint_field(1, interval_ms), _varint_field(3, 1), _varint_field(4, 1)]
+    for stats in interval['packages']:
+        body.append(_bytes_field(20, b''.join((
+            _varint_field(2, string_index(stats['package'])),
+            _varint_field(3, stats['last_time_active_ms']),
+            _varint_field(4, stats['total_time_active_ms']),
+            _varint_field(5, MOVE_TO_BACKGROUND),
+            _varint_field(6, stats['app_launch_count']),
+        ))))
+    for configuration in interval['configurations']:
+        body.append(_bytes_field(21, b''.join((
+            _varint_field(2, configuration['last_time_active_ms']),
+            _varint_field(3, configuration['total_time_active_ms']),
+            _varint_field(4, configuration['count']),
+        ))))
+    for event in interval['event_log']:
+        fields = [_varint_field(2, string_index(event['package']))]
+        if 'class' in event:
+            fields.append(_varint_field(4, string_index(event['class'])))
+        fields.append(_varint_field(5, event['time_ms']))
+        fields.append(_varint_field(7, event['type']))
+        body.append(_bytes_field(22, b''.join(fields)))
+
+    # Like Android, the stringpool is written after the records that use it
+    stringpool = _varint_field(1, len(strings)) + b''.join(_bytes_field(2, value.encode('utf-8')) for value in strings)
+    body.append(_bytes_field(2, stringpool))
+    return b''.join(body)
+
+
+def generate_corpus(dirpath, file_format='xml', files_per_interval=4, packages=50, events=1000, seed=0,
+                    start_ms=DEFAULT_START_MS):
+    """
+    Write a synthetic usagestats directory.
+    :param dirpath: The usagestats directory to create
+    :param file_format: xml, protobuf or mixed (every other file is protobuf)
+    :param files_per_interval: The amount of files in each of the daily, weekly, monthly and yearly directories
+    :param packages: The amount of packages in every file
+    :param events: The amount of events in the event log of every file
+    :param seed: Seed of the random generator, the same arguments give the same corpus
+    :param start_ms: The start time of the first file of every interval, in ms since EPOCH
+    :return: The amount of files and bytes written
+    """
+    if file_format not in ('xml', 'protobuf', 'mixed'):
+        raise ValueError('Unknown format: ' + file_format)
+    rng = random.Random(seed)
+    package_names = ['com.example.app%d' % number for number in range(packages)]
+
+    files = 0
+    size = 0
+    for frequency, interval_ms in INTERVALS:
+        directory = os.path.join(dirpath, frequency)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for number in range(files_per_interval):
+            interval = generate_interval(rng, interval_ms, package_names, events)
+            if file_format == 'protobuf' or (file_format == 'mixed' and files % 2):
+                content = to_protobuf(interval, interval_ms)
+            else:
+                content = to_xml(interval, interval_ms)
+            with open(os.path.join(directory, str(start_ms + number * interval_ms)), 'wb') as f:
+                f.write(content)
+            files += 1
+            size += len(content)
+    return files, size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic usagestats directory.')
+    parser.add_argument('dirpath', help='The usagestats directory to create')
+    parser.add_argument('--format', default='xml', choices=('xml', 'protobuf', 'mixed'),
+                        help='The format of the files, mixed alternates between XML and protobuf')
+    parser.add_argument('--files', type=int, default=4, help='Amount of files per interval directory')
+    parser.add_argument('--packages', type=int, default=50, help='Amount of packages per file')
+    parser.add_argument('--events', type=int, default=1000, help='Amount of events per file')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+    args = parser.parse_args()
+
+    files, size = generate_corpus(args.dirpath, args.format, args.files, args.packages, args.events, args.seed)
+    print('Generated ' + str(files) + ' files (' + str(size) + ' bytes) in ' + args.dirpath)
@@ -0,0 +1,466 @@
+"""
+Format detecting decoder for usagestats files.
+
+Android 9 and older write XML usagestats files, Android 10+ writes IntervalStatsProto protobuf files.
+The format is detected from the first bytes of a file, so no parse has to fail first.
+The protobuf files are decoded with a pure-Python reader (no compiled protobuf needed), so this module is shared by
+usagestats_conv.py and the Autopsy module and has to keep working under Jython 2.7.
+Credits for the protobuf layout go to Yogesh Khatri, see the readme for the blogpost.
+"""
+import binascii
+import struct
+
+try:
+    from sys import intern as _intern
+except ImportError:
+    # Python 2 (Jython), intern() only takes byte strings there and the stringpool holds unicode strings
+    _interned = {}
+
+    def _intern(value):
+        return _interned.setdefault(value, value)
+
+try:
+    import mmap
+except ImportError:
+    # Jython has no mmap, files are read into memory there
+    mmap = None
+
+from usagestats_metrics import timer, STAGE_READ, STAGE_DETECT, STAGE_PARSE, STAGE_DECODE
+from usagestats_xml import UsageRecord, absolute_time, iter_usagestats_records
+
+FORMAT_XML = 'xml'
+FORMAT_PROTOBUF = 'protobuf'
+FORMAT_UNKNOWN = 'unknown'
+
+# Amount of bytes read to detect the format of a file
+HEAD_SIZE = 64
+
+UTF8_BOM = b'\xef\xbb\xbf'
+
+# The names of the event types, indexed by their number
+EVENT_TYPE_NAMES = (
+    'NONE',
+    'MOVE_TO_FOREGROUND',
+    'MOVE_TO_BACKGROUND',
+    'END_OF_DAY',
+    'CONTINUE_PREVIOUS_DAY',
+    'CONFIGURATION_CHANGE',
+    'SYSTEM_INTERACTION',
+    'USER_INTERACTION',
+    'SHORTCUT_INVOCATION',
+    'CHOOSER_ACTION',
+    'NOTIFICATION_SEEN',
+    'STANDBY_BUCKET_CHANGED',
+    'NOTIFICATION_INTERRUPTION',
+    'SLICE_PINNED_PRIV',
+    'SLICE_PINNED',
+    'SCREEN_INTERACTIVE',
+    'SCREEN_NON_INTERACTIVE',
+    'KEYGUARD_SHOWN',
+    'KEYGUARD_HIDDEN',
+)
+
+# Protobuf wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+# Field numbers of IntervalStatsProto
+INTERVAL_STRINGPOOL = 2
+INTERVAL_PACKAGES = 20
+INTERVAL_CONFIGURATIONS = 21
+INTERVAL_EVENT_LOG = 22
+
+# Field numbers of IntervalStatsProto.StringPool
+STRINGPOOL_STRINGS = 2
+
+# Field names of IntervalStatsProto.UsageStats
+USAGESTATS_FIELDS = {
+    1: 'package',
+    2: 'package_index',
+    3: 'last_time_active_ms',
+    4: 'total_time_active_ms',
+    5: 'last_event',
+    6: 'app_launch_count',
+    8: 'last_time_service_used_ms',
+    9: 'total_time_service_used_ms',
+    10: 'last_time_visible_ms',
+    11: 'total_time_visible_ms',
+}
+
+# Field names of IntervalStatsProto.Configuration
+CONFIGURATION_FIELDS = {
+    1: 'config',
+    2: 'last_time_active_ms',
+    3: 'total_time_active_ms',
+    4: 'count',
+    5: 'active',
+}
+
+# Field names of IntervalStatsProto.Event
+EVENT_FIELDS = {
+    1: 'package',
+    2: 'package_index',
+    3: 'class',
+    4: 'class_index',
+    5: 'time_ms',
+    6: 'flags',
+    7: 'type',
+    8: 'config',
+    9: 'shortcut_id',
+    11: 'standby_bucket',
+    12: 'notification_channel',
+    13: 'notification_channel_index',
+    14: 'instance_id',
+    15: 'task_root_package_index',
+    16: 'task_root_class_index',
+    17: 'locus_id_index',
+}
+
+# Fields holding a string, the other length delimited fields are nested messages and are kept as hex
+STRING_FIELDS = ('package', 'class', 'shortcut_id', 'notification_channel')
+
+
+def _field_table(field_names):
+    """
+    :param field_names: A dict with the field names per field number
+    :return: A tuple indexed by field number, with a (name, is string) tuple for the known fields and None for the
+             others
+    """
+    return tuple((field_names[field], field_names[field] in STRING_FIELDS) if field in field_names else None
+                 for field in range(max(field_names) + 1))
+
+
+# The field names as lookup tables, built once so decoding a field is an index operation
+USAGESTATS_TABLE = _field_table(USAGESTATS_FIELDS)
+CONFIGURATION_TABLE = _field_table(CONFIGURATION_FIELDS)
+EVENT_TABLE = _field_table(EVENT_FIELDS)
+
+
+class DecodeError(ValueError):
+    """
+    Raised when a file is neither XML nor a valid usagestats protobuf.
+    """
+
+
+class _PrefixedReader(object):
+    """
+    File object that returns the bytes used for the format detection before the rest of the file.
+    """
+
+    def __init__(self, head, fileobj):
+        self._head = head
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._fileobj.read(size)
+        if size is None or size < 0:
+            data = self._head + self._fileobj.read()
+        else:
+            data = self._head[:size]
+        self._head = self._head[len(data):]
+        return data
+
+
+def event_type_name(event_type):
+    """
+    :param event_type: An event type as int
+    :return: The name of the event type, or the number as string when it is unknown
+    """
+    if 0 <= event_type < len(EVENT_TYPE_NAMES):
+        return EVENT_TYPE_NAMES[event_type]
+    return str(event_type)
+
+
+def detect_format(head):
+    """
+    Detect the format of a usagestats file from its first bytes.
+    :param head: The first bytes of the file
+    :return: FORMAT_XML, FORMAT_PROTOBUF or FORMAT_UNKNOWN
+    """
+    stripped = head[len(UTF8_BOM):] if head.startswith(UTF8_BOM) else head
+    stripped = stripped.lstrip()
+    if stripped.startswith(b'<'):
+        return FORMAT_XML
+
+    # A protobuf message starts with the key of a field: a field number and a known wire type
+    if head:
+        key = bytearray(head[:1])[0]
+        if key >> 3 > 0 and key & 7 in (WIRE_VARINT, WIRE_FIXED64, WIRE_LENGTH_DELIMITED, WIRE_FIXED32):
+            return FORMAT_PROTOBUF
+    return FORMAT_UNKNOWN
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 70:
+            raise DecodeError('Varint too long at offset ' + str(pos))
+
+
+def _iter_fields(buf, pos, end, clip=False):
+    """
+    Iterate over the fields of a protobuf message.
+    :param clip: Yield the part of a length delimited field that runs past the end, instead of raising DecodeError
+    :return: A generator of (field number, wire type, value) tuples. The value of a length delimited field is
+             a (start, end) tuple of offsets in buf.
+    """
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field = key >> 3
+        wire_type = key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            if clip and pos + length > end:
+                length = end - pos
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == WIRE_FIXED64:
+            value = struct.unpack_from('<q', buf, pos)[0]
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4
+        else:
+            raise DecodeError('Unsupported wire type ' + str(wire_type) + ' at offset ' + str(pos))
+        if pos > end:
+            raise DecodeError('Field ' + str(field) + ' runs past the end of its message')
+        yield field, wire_type, value
+
+
+def _decode_string(buf, span):
+    return bytes(buf[span[0]:span[1]]).decode('utf-8', 'replace')
+
+
+def _decode_message(buf, span, table):
+    """
+    Decode the known fields of a flat protobuf message.
+    This is the hot loop of the decoder, so the fields are read inline instead of with _iter_fields and single byte
+    varints (nearly every key and most values) are read without a function call.
+    :param table: The field names as lookup table, see _field_table
+    :return: A dict with the field names and values. Strings are decoded, nested messages are kept as hex.
+    """
+    fields = {}
+    pos, end = span
+    known = len(table)
+    while pos < end:
+        key = buf[pos]
+        if key < 0x80:
+            pos += 1
+        else:
+            key, pos = _read_varint(buf, pos)
+        field = key >> 3
+        wire_type = key & 7
+        if wire_type == WIRE_VARINT:
+            value = buf[pos]
+            pos += 1
+            if value >= 0x80:
+                # Times are multi byte varints, read inline as well
+                value &= 0x7f
+                shift = 7
+                while True:
+                    byte = buf[pos]
+                    pos += 1
+                    value |= (byte & 0x7f) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+                    if shift >= 70:
+                        raise DecodeError('Varint too long at offset ' + str(pos))
+                # int32 and int64 fields are encoded as 64 bit two's complement
+                if value >= 1 << 63:
+                    value -= 1 << 64
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            length = buf[pos]
+            if length < 0x80:
+                pos += 1
+            else:
+                length, pos = _read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == WIRE_FIXED64:
+            value = struct.unpack_from('<q', buf, pos)[0]
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4
+        else:
+            raise DecodeError('Unsupported wire type ' + str(wire_type) + ' at offset ' + str(pos))
+        if pos > end:
+            raise DecodeError('Field ' + str(field) + ' runs past the end of its message')
+
+        entry = table[field] if field < known else None
+        if entry is None:
+            continue
+        name, is_string = entry
+        if wire_type == WIRE_LENGTH_DELIMITED:
+            if is_string:
+                value = _decode_string(buf, value)
+            else:
+                value = binascii.hexlify(bytes(buf[value[0]:value[1]])).decode('ascii')
+        fields[name] = value
+    return fields
+
+
+def _pool_lookup(fields, name, index_name, pool):
+    """
+    :return: The string field of a record, either stored in the record itself or as index in the stringpool
+    """
+    value = fields.get(name)
+    if value is None:
+        index = fields.get(index_name)
+        if index is not None and 0 < index < len(pool):
+            value = pool[index]
+    return value
+
+
+def _abs_or_none(value):
+    return None if value is None else abs(value)
+
+
+def _decode_stringpool(buf):
+    """
+    Decode the stringpool of an IntervalStatsProto, only the keys of the other top level fields are read.
+    The strings are interned, so the package and class names of all records (and files) share the same objects.
+    Android writes the stringpool after the records, so it is the first thing lost when a (carved) file is truncated.
+    The strings before the truncation are still returned, the records decide how far they can be decoded.
+    :return: A list with the strings of the pool, indexed like the records do: starting at 1, so the first item is
+             None
+    """
+    strings = [None]
+    try:
+        for field, wire_type, value in _iter_fields(buf, 0, len(buf), clip=True):
+            if field == INTERVAL_STRINGPOOL and wire_type == WIRE_LENGTH_DELIMITED:
+                for pool_field, pool_wire_type, pool_value in _iter_fields(buf, value[0], value[1]):
+                    if pool_field == STRINGPOOL_STRINGS and pool_wire_type == WIRE_LENGTH_DELIMITED:
+                        strings.append(_intern(_decode_string(buf, pool_value)))
+                break
+    except (DecodeError, IndexError, struct.error):
+        pass
+    return strings
+
+
+def iter_protobuf_records(buf, filename):
+    """
+    Decode an IntervalStatsProto usagestats file.
+    The stringpool is decoded once up front, after that every record is decoded when it is reached,
+    so no more than a single record is decoded at once. The records before the truncation of a truncated file are
+    yielded before DecodeError is raised, their names are None when the part of the stringpool they refer to is lost.
+    :param buf: The content of the file, indexing it must return ints (bytes or a memoryview on Python 3,
+                or a bytearray)
+    :param filename: The filename being parsed, already checked if it only contains numbers.
+                    This represents an EPOCH timestamp
+    :return: A generator of usagestats_xml.UsageRecord
+    """
+    try:
+        # The stringpool is needed to decode the records, and it doesn't have to be the first field
+        pool = _decode_stringpool(buf)
+        # The start time of the file, the times in the records are relative to it (see absolute_time)
+        start_time = int(filename)
+
+        for field, wire_type, span in _iter_fields(buf, 0, len(buf)):
+            if wire_type != WIRE_LENGTH_DELIMITED:
+                continue
+
+            if field == INTERVAL_EVENT_LOG:
+                fields = _decode_message(buf, span, EVENT_TABLE)
+                time = fields.get('time_ms')
+                if time is not None:
+                    time = -time if time < 0 else start_time + time
+                yield UsageRecord('event-log', time, _pool_lookup(fields, 'package', 'package_index', pool),
+                                  _pool_lookup(fields, 'class', 'class_index', pool), fields.get('type'), None, None,
+                                  fields)
+
+            elif field == INTERVAL_PACKAGES:
+                fields = _decode_message(buf, span, USAGESTATS_TABLE)
+                time = fields.get('last_time_active_ms')
+                yield UsageRecord('packages', None if time is None else absolute_time(time, filename),
+                                  _pool_lookup(fields, 'package', 'package_index', pool), None, None,
+                                  _abs_or_none(fields.get('total_time_active_ms')),
+                                  _abs_or_none(fields.get('app_launch_count')), fields)
+
+            elif field == INTERVAL_CONFIGURATIONS:
+                fields = _decode_message(buf, span, CONFIGURATION_TABLE)
+                time = fields.get('last_time_active_ms')
+                yield UsageRecord('configurations', None if time is None else absolute_time(time, filename), None,
+                                  None, None, _abs_or_none(fields.get('total_time_active_ms')), None, fields)
+    except (IndexError, struct.error):
+        raise DecodeError('Truncated protobuf file')
+
+
+def iter_usagestats_file(source, filename, metrics=None):
+    """
+    Decode a usagestats file, either XML or protobuf, one record at a time.
+    Raises xml.etree.ElementTree.ParseError for broken XML files and DecodeError for anything else
+    that can't be decoded. Both can happen halfway through a file.
+    :param source: A path or a (binary) file object of the usagestats file.
+    :param filename: The filename being parsed, already checked if it only contains numbers.
+                    This represents an EPOCH timestamp
+    :param metrics: An optional usagestats_metrics.Metrics, that gets the time spent reading, detecting the format
+                    and parsing or decoding
+    :return: A generator of usagestats_xml.UsageRecord
+    """
+    if hasattr(source, 'read'):
+        fileobj = source
+    else:
+        fileobj = open(source, 'rb')
+
+    mapped = None
+    buf = None
+    try:
+        started = timer()
+        head = fileobj.read(HEAD_SIZE)
+        detecting = timer()
+        file_format = detect_format(head)
+        if metrics is not None:
+            metrics.add(STAGE_READ, detecting - started, size=len(head))
+            metrics.add(STAGE_DETECT, timer() - detecting)
+
+        started = timer()
+        if file_format == FORMAT_XML:
+            stage = STAGE_PARSE
+            records = iter_usagestats_records(_PrefixedReader(head, fileobj), filename)
+        elif file_format == FORMAT_PROTOBUF and fileobj is not source and mmap is not None:
+            # Map the file instead of reading it, only the fields of the record being decoded are copied
+            stage = STAGE_DECODE
+            mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = memoryview(mapped)
+            records = iter_protobuf_records(buf, filename)
+            if metrics is not None:
+                metrics.add(STAGE_READ, timer() - started, size=len(mapped) - len(head))
+        elif file_format == FORMAT_PROTOBUF:
+            stage = STAGE_DECODE
+            buf = head + fileobj.read()
+            if str is bytes:
+                # Python 2 (Jython), indexing a str returns characters instead of ints
+                buf = bytearray(buf)
+            records = iter_protobuf_records(buf, filename)
+            if metrics is not None:
+                metrics.add(STAGE_READ, timer() - started, size=len(buf) - len(head))
+        else:
+            raise DecodeError('Not an XML or protobuf usagestats file')
+
+        if metrics is not None:
+            records = metrics.timed_records(stage, records)
+        try:
+            for record in records:
+                yield record
+        finally:
+            records.close()
+    finally:
+        if mapped is not None:
+            buf.release()
+            mapped.close()
+        if fileobj is not source:
+            fileobj.close()
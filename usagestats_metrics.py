@@ -0,0 +1,203 @@
+"""
+Per-stage timers and counters of an ingest, shared by usagestats_conv.py and the Autopsy module.
+Runs on Jython 2.7 as well, like the decoder.
+
+Stages:
+    read: reading (and hashing) the content of the files
+    detect: detecting the format from the first bytes of a file
+    parse: parsing the records of the XML files, the XML files are streamed so this includes reading them
+    decode: decoding the records of the protobuf files
+    insert: converting and writing the rows to the database (usagestats_conv.py)
+    artifact: creating and posting the blackboard artifacts (Autopsy)
+    report: writing the HTML report
+"""
+import heapq
+import json
+import time
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    # Python 2 (Jython)
+    timer = time.time
+
+STAGE_READ = 'read'
+STAGE_DETECT = 'detect'
+STAGE_PARSE = 'parse'
+STAGE_DECODE = 'decode'
+STAGE_INSERT = 'insert'
+STAGE_ARTIFACT = 'artifact'
+STAGE_REPORT = 'report'
+
+STAGES = (STAGE_READ, STAGE_DETECT, STAGE_PARSE, STAGE_DECODE, STAGE_INSERT, STAGE_ARTIFACT, STAGE_REPORT)
+
+# Stages that produce the records of a file
+RECORD_STAGES = (STAGE_PARSE, STAGE_DECODE)
+
+# Amount of slowest files listed in the summary
+SLOWEST_FILES = 10
+
+
+class _StageTimer(object):
+    """
+    Context manager that adds the time spent in its block to a stage.
+    """
+
+    def __init__(self, metrics, stage, rows, size):
+        self.metrics = metrics
+        self.stage = stage
+        self.rows = rows
+        self.size = size
+
+    def __enter__(self):
+        self.started = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.add(self.stage, timer() - self.started, self.rows, self.size)
+        return False
+
+
+class Metrics(object):
+    """
+    Time, amount of calls, rows and bytes per stage, and the slowest files.
+    A Metrics isn't thread safe, every thread (or worker process) keeps its own and they are merged afterwards.
+    """
+
+    def __init__(self):
+        self.started = timer()
+        self.seconds = {}
+        self.calls = {}
+        self.rows = {}
+        self.bytes = {}
+        self.files = 0
+        # Heap of (seconds, path, rows, bytes) tuples, the fastest of the slowest files on top
+        self.slowest = []
+
+    def add(self, stage, seconds, rows=0, size=0):
+        """
+        Add a measurement to a stage.
+        :param stage: One of STAGES
+        :param seconds: The time spent in the stage
+        :param rows: The amount of rows (or records) handled
+        :param size: The amount of bytes handled
+        """
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        if rows:
+            self.rows[stage] = self.rows.get(stage, 0) + rows
+        if size:
+            self.bytes[stage] = self.bytes.get(stage, 0) + size
+
+    def timed(self, stage, rows=0, size=0):
+        """
+        :return: A context manager that adds the time spent in its block to a stage
+        """
+        return _StageTimer(self, stage, rows, size)
+
+    def timed_records(self, stage, records):
+        """
+        Time a generator of records, only the time spent producing the records is added to the stage,
+        not the time the consumer spends on them.
+        :param stage: The stage of the generator, STAGE_PARSE or STAGE_DECODE
+        :param records: An iterable of records
+        :return: A generator of the same records
+        """
+        records = iter(records)
+        seconds = 0.0
+        rows = 0
+        try:
+            while True:
+                started = timer()
+                try:
+                    record = next(records)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += timer() - started
+                rows += 1
+                yield record
+        finally:
+            if hasattr(records, 'close'):
+                records.close()
+            self.add(stage, seconds, rows)
+
+    def total(self):
+        """
+        :return: The time spent in all stages together
+        """
+        return sum(self.seconds.values())
+
+    def record_rows(self):
+        """
+        :return: The amount of records parsed and decoded
+        """
+        return sum(self.rows.get(stage, 0) for stage in RECORD_STAGES)
+
+    def merge(self, other):
+        """
+        Add the measurements of another Metrics, for example of another thread or a single file.
+        """
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        for counters, other_counters in ((self.calls, other.calls), (self.rows, other.rows),
+                                         (self.bytes, other.bytes)):
+            for stage, value in other_counters.items():
+                counters[stage] = counters.get(stage, 0) + value
+        self.files += other.files
+        for item in other.slowest:
+            self._add_slowest(item)
+
+    def add_file(self, path, seconds, file_metrics, size=0):
+        """
+        Add the measurements of a single file.
+        :param path: The path of the file
+        :param seconds: The total time spent on the file
+        :param file_metrics: A Metrics with the stages of only this file
+        :param size: The size of the file
+        """
+        self.merge(file_metrics)
+        self.files += 1
+        self._add_slowest((seconds, path, file_metrics.record_rows(), size))
+
+    def _add_slowest(self, item):
+        if len(self.slowest) < SLOWEST_FILES:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def summary(self, **extra):
+        """
+        :param extra: Other values to include, like the amount of skipped files
+        :return: A dict with the measurements, that can be written as JSON
+        """
+        stages = {}
+        for stage in STAGES:
+            if stage not in self.calls:
+                continue
+            seconds = self.seconds[stage]
+            rows = self.rows.get(stage, 0)
+            size = self.bytes.get(stage, 0)
+            stages[stage] = {
+                'seconds': round(seconds, 6),
+                'calls': self.calls[stage],
+                'rows': rows,
+                'bytes': size,
+                'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+                'bytes_per_sec': round(size / seconds, 1) if seconds else None,
+            }
+        result = {
+            'wall_seconds': round(timer() - self.started, 6),
+            'files': self.files,
+            'stages': stages,
+            'slowest_files': [{'path': path, 'seconds': round(seconds, 6), 'rows': rows, 'bytes': size}
+                              for seconds, path, rows, size in sorted(self.slowest, reverse=True)],
+        }
+        result.update(extra)
+        return result
+
+    def to_json(self, **extra):
+        """
+        :return: The summary as a single line of JSON
+        """
+        return json.dumps(self.summary(**extra), sort_keys=True)
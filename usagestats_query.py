@@ -0,0 +1,284 @@
+"""
+Query a database created by usagestats_conv.py, without writing a full report.
+
+The events are filtered on time range, package, event type and interval source. The filters map onto the indexes
+of the data table (lastime and package_id, lastime), and the results are returned in pages that continue after the
+last row of the previous page, so every page is a range scan instead of an OFFSET over everything before it.
+
+The aggregates (top apps per day, launch counts per package) are computed from the packages records of the daily
+files, the weekly, monthly and yearly files hold the same usage again. Their results are cached in the database and
+are used until the database changes.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from usagestats_decoder import EVENT_TYPE_NAMES, event_type_name
+
+DEFAULT_PAGE_SIZE = 1000
+
+# A row of the data table. time is in ms since EPOCH, intervals lists the frequencies a deduplicated event
+# appeared in (or only its source).
+Event = namedtuple('Event', ['id', 'usage_type', 'time', 'package', 'class_name', 'type', 'intervals',
+                             'time_active', 'app_launch_count'])
+
+EVENTS_QUERY = '''
+        select id, usage_type, lastime, package, classs, types, coalesce(intervals, source), timeactive,
+               app_launch_count
+        from data_view
+        where lastime is not null and %s
+        order by lastime, id
+        limit ?
+        '''
+
+# Aggregates on the packages records of the daily files
+TOP_APPS_QUERY = '''
+        select day, strings.value, time_active from (
+            select day, package_id, time_active,
+                   row_number() over (partition by day order by time_active desc, package_id) as rank
+            from (
+                select date((lastime + ?) / 1000, 'unixepoch') as day, package_id, sum(timeactive) as time_active
+                from data
+                where usage_type = 'packages' and source = 'daily' and lastime >= ? and lastime < ?
+                group by day, package_id
+            )
+        )
+        join strings on strings.id = package_id
+        where rank <= ?
+        order by day, time_active desc, strings.value
+        '''
+
+LAUNCH_COUNTS_QUERY = '''
+        select strings.value, sum(app_launch_count) as launches
+        from data
+        join strings on strings.id = data.package_id
+        where usage_type = 'packages' and source = 'daily' and lastime >= ? and lastime < ?
+        group by data.package_id
+        order by launches desc, strings.value
+        '''
+
+# Times used for an open end of a time range
+MIN_TIME = -(1 << 63)
+MAX_TIME = (1 << 63) - 1
+
+
+def parse_time(value):
+    """
+    :param value: ms since EPOCH, or an ISO 8601 date and time (localtime when no offset is given)
+    :return: The time in ms since EPOCH
+    """
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def parse_event_type(value):
+    """
+    :param value: An event type as number or name, like 1 or MOVE_TO_FOREGROUND
+    :return: The event type as int
+    """
+    if value.isdigit():
+        return int(value)
+    if value.upper() not in EVENT_TYPE_NAMES:
+        raise ValueError('Unknown event type: ' + value)
+    return EVENT_TYPE_NAMES.index(value.upper())
+
+
+class UsagestatsQuery:
+    """
+    Queries on an usagestats database.
+    """
+
+    def __init__(self, db, page_size=DEFAULT_PAGE_SIZE):
+        """
+        :param db: handle to a database created by usagestats_conv.py
+        :param page_size: The default amount of rows per page
+        """
+        self.db = db
+        self.page_size = max(1, page_size)
+
+    def string_ids(self, values):
+        """
+        :param values: Package (or class) names
+        :return: The ids of the names in the strings table, names that aren't in the database are left out
+        """
+        values = list(values)
+        return [row[0] for row in self.db.execute(
+            'SELECT id FROM strings WHERE value IN (%s)' % ', '.join('?' * len(values)), values)]
+
+    def events(self, start=None, end=None, packages=(), event_types=(), sources=(), usage_types=(),
+               page_size=None):
+        """
+        Find the rows in a time range, ordered by time. Rows without a time are left out.
+        :param start: The start of the time range in ms since EPOCH (inclusive), None for no start
+        :param end: The end of the time range in ms since EPOCH (exclusive), None for no end
+        :param packages: Only return rows of these package names
+        :param event_types: Only return rows with these event types (ints)
+        :param sources: Only return rows from these intervals (daily, weekly, monthly or yearly). A deduplicated event
+                        matches when it appeared in one of them.
+        :param usage_types: Only return these kinds of rows (packages, configurations or event-log)
+        :param page_size: The amount of rows per page
+        :return: A generator of pages, lists of Event
+        """
+        conditions = ['lastime < ?']
+        params = [MAX_TIME if end is None else end]
+        if packages:
+            package_ids = self.string_ids(packages)
+            if not package_ids:
+                return
+            conditions.append('package_id IN (%s)' % ', '.join('?' * len(package_ids)))
+            params.extend(package_ids)
+        if event_types:
+            conditions.append('types IN (%s)' % ', '.join('?' * len(event_types)))
+            params.extend(event_types)
+        if sources:
+            placeholders = ', '.join('?' * len(sources))
+            conditions.append('(source IN (%s) OR id IN (SELECT data_id FROM event_occurrences WHERE source IN (%s)))'
+                              % (placeholders, placeholders))
+            params.extend(sources)
+            params.extend(sources)
+        if usage_types:
+            conditions.append('usage_type IN (%s)' % ', '.join('?' * len(usage_types)))
+            params.extend(usage_types)
+        # Every page continues after the (time, id) of the last row of the previous page
+        conditions.append('lastime >= ? AND (lastime > ? OR id > ?)')
+        query = EVENTS_QUERY % ' AND '.join(conditions)
+
+        page_size = page_size or self.page_size
+        last_time = MIN_TIME if start is None else start
+        # The ids start at 1, so the first page starts at the first row of the start time
+        last_id = -1
+        while True:
+            page = [Event(*row) for row in self.db.execute(query, params + [last_time, last_time, last_id,
+                                                                           page_size])]
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            last_time = page[-1].time
+            last_id = page[-1].id
+
+    def database_fingerprint(self):
+        """
+        :return: A hash that changes whenever files are (re-)ingested or the database is rebuilt
+        """
+        digest = hashlib.sha256()
+        digest.update(str(self.db.execute('SELECT max(id) FROM data').fetchone()[0]).encode())
+        for file_id, file_hash in self.db.execute('SELECT id, hash FROM manifest ORDER BY id'):
+            digest.update(('%d:%s;' % (file_id, file_hash)).encode())
+        return digest.hexdigest()
+
+    def cached(self, name, query, params):
+        """
+        Run an aggregate query, or return its result from the aggregate_cache table.
+        The cache is skipped when the database is read-only.
+        :param name: The name of the aggregate
+        :param query: The query
+        :param params: The parameters of the query
+        :return: A list with the rows as tuples
+        """
+        key = json.dumps([name, params])
+        fingerprint = self.database_fingerprint()
+        try:
+            self.db.execute('CREATE TABLE IF NOT EXISTS aggregate_cache(key TEXT PRIMARY KEY, fingerprint TEXT, '
+                            'result TEXT)')
+            row = self.db.execute('SELECT result FROM aggregate_cache WHERE key = ? AND fingerprint = ?',
+                                  (key, fingerprint)).fetchone()
+        except sqlite3.OperationalError:
+            return self.db.execute(query, params).fetchall()
+        if row is not None:
+            return [tuple(values) for values in json.loads(row[0])]
+
+        result = self.db.execute(query, params).fetchall()
+        try:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO aggregate_cache (key, fingerprint, result) VALUES (?, ?, ?)',
+                                (key, fingerprint, json.dumps(result)))
+        except sqlite3.OperationalError:
+            # Read-only, but the cache table was created before
+            pass
+        return result
+
+    def top_apps_per_day(self, limit=10, start=None, end=None, utc_offset_ms=0):
+        """
+        The apps that were in the foreground the longest, per day.
+        :param limit: The amount of apps per day
+        :param start: The start of the time range in ms since EPOCH (inclusive), None for no start
+        :param end: The end of the time range in ms since EPOCH (exclusive), None for no end
+        :param utc_offset_ms: Offset of the local time zone, the days start at midnight local time
+        :return: A list of (day, package, time in the foreground in ms) tuples, ordered by day and time
+        """
+        return self.cached('top_apps_per_day', TOP_APPS_QUERY, [
+            utc_offset_ms, MIN_TIME if start is None else start, MAX_TIME if end is None else end, limit])
+
+    def launch_counts(self, start=None, end=None):
+        """
+        The amount of times every app was launched.
+        :param start: The start of the time range in ms since EPOCH (inclusive), None for no start
+        :param end: The end of the time range in ms since EPOCH (exclusive), None for no end
+        :return: A list of (package, launches) tuples, ordered by launches
+        """
+        return self.cached('launch_counts', LAUNCH_COUNTS_QUERY, [MIN_TIME if start is None else start,
+                                                                  MAX_TIME if end is None else end])
+
+
+def format_time(ms):
+    """
+    :return: The time as localtime with ms, like 2020-05-10 02:00:00.123
+    """
+    return datetime.fromtimestamp(ms / 1000).isoformat(' ', 'milliseconds')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query a database created by usagestats_conv.py.')
+    parser.add_argument('db', help='The usagestats database')
+    parser.add_argument('--from', dest='start', type=parse_time, metavar='TIME',
+                        help='Start of the time range (ms since EPOCH or ISO 8601, localtime when no offset is given)')
+    parser.add_argument('--to', dest='end', type=parse_time, metavar='TIME', help='End of the time range (exclusive)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    events_parser = subparsers.add_parser('events', help='The rows in the time range, ordered by time')
+    events_parser.add_argument('-p', '--package', action='append', default=[], help='Only rows of this package')
+    events_parser.add_argument('-t', '--type', action='append', default=[], type=parse_event_type,
+                               help='Only rows with this event type (number or name)')
+    events_parser.add_argument('-s', '--source', action='append', default=[],
+                               choices=('daily', 'weekly', 'monthly', 'yearly'), help='Only rows from this interval')
+    events_parser.add_argument('-u', '--usage-type', action='append', default=[],
+                               choices=('packages', 'configurations', 'event-log'), help='Only rows of this kind')
+    events_parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                               help='Amount of rows fetched at once')
+
+    top_apps_parser = subparsers.add_parser('top-apps', help='The apps in the foreground the longest, per day')
+    top_apps_parser.add_argument('--limit', type=int, default=10, help='Amount of apps per day')
+    top_apps_parser.add_argument('--utc-offset', type=int, default=time.localtime().tm_gmtoff // 60,
+                                 metavar='MINUTES',
+                                 help='Offset of the time zone the days are counted in, defaults to localtime')
+
+    subparsers.add_parser('launches', help='The amount of launches per app')
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as db:
+        query = UsagestatsQuery(db)
+        output = csv.writer(sys.stdout)
+        if args.command == 'events':
+            output.writerow(['time', 'usage_type', 'package', 'class', 'type', 'intervals', 'time_active',
+                             'app_launch_count'])
+            for page in query.events(args.start, args.end, args.package, args.type, args.source, args.usage_type,
+                                     args.page_size):
+                output.writerows([format_time(event.time), event.usage_type, event.package, event.class_name,
+                                  '' if event.type is None else event_type_name(event.type), event.intervals,
+                                  event.time_active, event.app_launch_count] for event in page)
+        elif args.command == 'top-apps':
+            output.writerow(['day', 'package', 'time_active_secs'])
+            for day, package, time_active in query.top_apps_per_day(args.limit, args.start, args.end,
+                                                                     args.utc_offset * 60 * 1000):
+                output.writerow([day, package, time_active / 1000])
+        else:
+            output.writerow(['package', 'launches'])
+            output.writerows(query.launch_counts(args.start, args.end))
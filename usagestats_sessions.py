@@ -0,0 +1,229 @@
+"""
+Reconstruct app sessions from the usage events and aggregate them to screen time per app per day.
+
+Everything works on sorted numpy arrays, in bulk, instead of looping over the events in Python or self-joining the
+data table. The events can be loaded from the usagestats database or from a .npz export (see usagestats_columnar).
+Needs numpy.
+
+A session starts at a MOVE_TO_FOREGROUND event and ends at the MOVE_TO_BACKGROUND event of the same package that
+directly follows it. The screen turning off (SCREEN_NON_INTERACTIVE) or the keyguard showing (KEYGUARD_SHOWN) ends
+every session that is still open at that time. A foreground event without a matching background event is not
+counted, its end can't be known.
+"""
+import argparse
+import csv
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+from usagestats_query import parse_time
+
+MOVE_TO_FOREGROUND = 1
+MOVE_TO_BACKGROUND = 2
+SCREEN_NON_INTERACTIVE = 16
+KEYGUARD_SHOWN = 17
+
+# Event types that end every open session
+SESSION_END_TYPES = (SCREEN_NON_INTERACTIVE, KEYGUARD_SHOWN)
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Package code of events without package, and the result of foreground_at when no app was in the foreground
+NO_PACKAGE = -1
+
+EVENT_DTYPE = np.dtype([('time', np.int64), ('package', np.int32), ('type', np.uint8)])
+SCREEN_TIME_DTYPE = np.dtype([('day', 'datetime64[D]'), ('package', np.int32), ('duration_ms', np.int64)])
+
+EVENTS_QUERY = '''
+        select lastime, coalesce(package_id, -1), types
+        from data
+        where usage_type = 'event-log' and lastime is not null and types in (%s)
+        ''' % ', '.join(str(event_type) for event_type in (MOVE_TO_FOREGROUND, MOVE_TO_BACKGROUND) + SESSION_END_TYPES)
+
+
+def load_events_db(db):
+    """
+    Load the events needed for the sessions from an usagestats database.
+    :param db: handle to a database created by usagestats_conv.py
+    :return: An EVENT_DTYPE array and a list with the package name of every package code
+    """
+    events = np.fromiter(db.execute(EVENTS_QUERY), dtype=EVENT_DTYPE)
+    strings = db.execute('SELECT id, value FROM strings').fetchall()
+    # The package codes are ids in the strings table
+    names = [None] * (max([string_id for string_id, value in strings] or [0]) + 1)
+    for string_id, value in strings:
+        names[string_id] = value
+    return events, names
+
+
+def load_events_npz(path):
+    """
+    Load the events needed for the sessions from a .npz export.
+    :param path: The .npz file written by usagestats_columnar.ColumnarWriter
+    :return: An EVENT_DTYPE array and a list with the package name of every package code
+    """
+    with np.load(path) as columns:
+        usage_types = list(columns['usage_types'])
+        if 'event-log' not in usage_types:
+            return np.empty(0, dtype=EVENT_DTYPE), list(columns['strings'])
+        mask = columns['usage_type'] == usage_types.index('event-log')
+        mask &= np.isin(columns['type'], (MOVE_TO_FOREGROUND, MOVE_TO_BACKGROUND) + SESSION_END_TYPES)
+        mask &= columns['time'] >= 0
+        events = np.empty(np.count_nonzero(mask), dtype=EVENT_DTYPE)
+        events['time'] = columns['time'][mask]
+        events['package'] = columns['package'][mask]
+        events['type'] = columns['type'][mask]
+        return events, list(columns['strings'])
+
+
+def unique_events(events):
+    """
+    The daily, weekly, monthly and yearly files hold copies of the same events, keep one of each.
+    :param events: An EVENT_DTYPE array
+    :return: The unique events, sorted by time, package and type
+    """
+    events = events[np.lexsort((events['type'], events['package'], events['time']))]
+    keep = np.ones(len(events), dtype=bool)
+    keep[1:] = events[1:] != events[:-1]
+    return events[keep]
+
+
+class Sessions:
+    """
+    The foreground sessions of the apps, sorted by start time.
+    package, start and end are arrays of the same length, start and end are in ms since EPOCH.
+    """
+
+    def __init__(self, package, start, end, names):
+        order = np.argsort(start, kind='stable')
+        self.package = package[order]
+        self.start = start[order]
+        self.end = end[order]
+        self.names = names
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def from_events(cls, events, names):
+        """
+        Pair the foreground and background events to sessions.
+        :param events: An EVENT_DTYPE array, in any order and possibly with duplicates
+        :param names: A list with the package name of every package code
+        :return: Sessions
+        """
+        events = unique_events(events)
+
+        # Order the app events per package by time, a foreground event sorts before a background event of the
+        # same millisecond
+        apps = events[np.isin(events['type'], (MOVE_TO_FOREGROUND, MOVE_TO_BACKGROUND))]
+        apps = apps[np.lexsort((apps['type'], apps['time'], apps['package']))]
+        paired = ((apps['type'][:-1] == MOVE_TO_FOREGROUND) & (apps['type'][1:] == MOVE_TO_BACKGROUND) &
+                  (apps['package'][:-1] == apps['package'][1:]))
+        first = np.flatnonzero(paired)
+        package = apps['package'][first]
+        start = apps['time'][first]
+        end = apps['time'][first + 1]
+
+        # End the sessions at the first screen off or keyguard event after their start
+        ends = np.sort(events['time'][np.isin(events['type'], SESSION_END_TYPES)])
+        if len(ends):
+            following = np.searchsorted(ends, start, side='right')
+            has_following = following < len(ends)
+            end = np.where(has_following, np.minimum(end, ends[np.minimum(following, len(ends) - 1)]), end)
+
+        return cls(package, start, end, names)
+
+    def daily_screen_time(self, utc_offset_ms=0):
+        """
+        Sum the session durations per package per day. Sessions running past midnight are split over the days.
+        :param utc_offset_ms: Offset of the local time zone, the days start at midnight local time
+        :return: A SCREEN_TIME_DTYPE array, sorted by day and package
+        """
+        keep = self.end > self.start
+        start = self.start[keep] + utc_offset_ms
+        end = self.end[keep] + utc_offset_ms
+        package = self.package[keep]
+
+        first_day = start // DAY_MS
+        days = (end - 1) // DAY_MS - first_day + 1
+        session = np.repeat(np.arange(len(start)), days)
+        day = first_day[session] + np.arange(days.sum()) - np.repeat(np.cumsum(days) - days, days)
+        duration = np.minimum(end[session], (day + 1) * DAY_MS) - np.maximum(start[session], day * DAY_MS)
+
+        keys, inverse = np.unique(np.stack((day, package[session].astype(np.int64)), axis=1), axis=0,
+                                  return_inverse=True)
+        totals = np.bincount(inverse.ravel(), weights=duration, minlength=len(keys))
+
+        result = np.empty(len(keys), dtype=SCREEN_TIME_DTYPE)
+        result['day'] = keys[:, 0].astype('datetime64[D]')
+        result['package'] = keys[:, 1]
+        result['duration_ms'] = totals
+        return result
+
+    def foreground_at(self, times):
+        """
+        Look up which app was in the foreground, for any amount of times at once.
+        When sessions overlap, the one that started last wins.
+        :param times: A time or an array of times, in ms since EPOCH
+        :return: An array with the package code per time, NO_PACKAGE when no app was in the foreground
+        """
+        times = np.atleast_1d(np.asarray(times, dtype=np.int64))
+        if not len(self):
+            return np.full(len(times), NO_PACKAGE, dtype=np.int32)
+        # The last session that started at or before every time
+        index = np.searchsorted(self.start, times, side='right') - 1
+
+        # A longer session that started before it can still be running, walk back to the last session that ends
+        # after the time. levels[k][i] is the latest end of the sessions i - 2**k + 1 up to i, so every step skips
+        # a block of sessions that all ended before the time.
+        levels = [self.end]
+        width = 1
+        while width < len(self):
+            level = levels[-1].copy()
+            level[width:] = np.maximum(level[width:], levels[-1][:-width])
+            levels.append(level)
+            width *= 2
+        for k in range(len(levels) - 1, -1, -1):
+            skip = (index >= 0) & (levels[k][np.maximum(index, 0)] <= times)
+            index = np.where(skip, index - (1 << k), index)
+        return np.where(index >= 0, self.package[np.maximum(index, 0)], NO_PACKAGE)
+
+    def name(self, package):
+        """
+        :param package: A package code
+        :return: The package name, or an empty string
+        """
+        if package < 0 or package >= len(self.names) or self.names[package] is None:
+            return ''
+        return str(self.names[package])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconstruct app sessions and the screen time per app per day.')
+    parser.add_argument('source', help='An usagestats database or .npz export')
+    parser.add_argument('--at', action='append', default=[], metavar='TIME',
+                        help='Show the app in the foreground at this time (ms since EPOCH or ISO 8601), '
+                             'instead of the screen time per day. Can be given more than once.')
+    parser.add_argument('--utc-offset', type=int, default=time.localtime().tm_gmtoff // 60, metavar='MINUTES',
+                        help='Offset of the time zone the days are counted in, defaults to localtime')
+    args = parser.parse_args()
+
+    if args.source.endswith('.npz'):
+        events, names = load_events_npz(args.source)
+    else:
+        with sqlite3.connect(args.source) as db:
+            events, names = load_events_db(db)
+    sessions = Sessions.from_events(events, names)
+
+    output = csv.writer(sys.stdout)
+    if args.at:
+        output.writerow(['time', 'package'])
+        for value, package in zip(args.at, sessions.foreground_at([parse_time(value) for value in args.at])):
+            output.writerow([value, sessions.name(package)])
+    else:
+        output.writerow(['day', 'package', 'screen_time_secs'])
+        for day, package, duration_ms in sessions.daily_screen_time(args.utc_offset * 60 * 1000):
+            output.writerow([day, sessions.name(package), duration_ms / 1000])
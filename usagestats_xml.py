@@ -0,0 +1,93 @@
+"""
+Streaming parser for the XML usagestats files (Android 9 and older).
+
+This module is shared by usagestats_conv.py and the Autopsy module, so it has to keep working under Jython 2.7.
+"""
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+# A single normalized usagestats record.
+# usage_type: the section the record was found in (packages, configurations or event-log)
+# time: the absolute time in ms since EPOCH, or None
+# package, class_name: the package and class, or None
+# type: the event type as int, or None
+# time_active, app_launch_count: as int, or None
+# attributes: all attributes of the XML element
+UsageRecord = namedtuple('UsageRecord', ['usage_type', 'time', 'package', 'class_name', 'type',
+                                         'time_active', 'app_launch_count', 'attributes'])
+
+# Depth of the elements that hold a record: <usagestats> <packages> <package />
+RECORD_DEPTH = 3
+
+
+def absolute_time(relative_time, filename):
+    """
+    Calculate the absolute time (in EPOCH) of a time stored in a usagestats file.
+    :param relative_time: The time as stored in the file, in ms.
+    :param filename: A filename where the name contains digits only, representing the creation time in EPOCH.
+    :return: The EPOCH representation (in ms) of the time.
+    """
+    relative_time = int(relative_time)
+
+    # Some events show the time as EPOCH already, which is indicated by starting with a minus sign
+    if relative_time < 0:
+        return abs(relative_time)
+
+    # Otherwise we need to add the filename (which is the start time in EPOCH)
+    # to the relative time (represented in ms)
+    return int(filename) + relative_time
+
+
+def _int_or_none(value):
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def iter_usagestats_records(source, filename):
+    """
+    Parse an XML usagestats file one record at a time.
+    Every element is cleared as soon as its record has been yielded, so memory use is bounded per record
+    instead of per file.
+    Raises ET.ParseError when the file is not (or no longer) valid XML, which can happen halfway through the file.
+
+    Example how a record looks like:
+        <package lastTimeActive="-1589192784125"  package="com.samsung.android.provider.filterprovider"
+            timeActive="0" lastEvent="0" />
+
+    :param source: A path or a file object of the usagestats file.
+    :param filename: The filename being parsed, already checked if it only contains numbers.
+                    This represents an EPOCH timestamp
+    :return: A generator of UsageRecord
+    """
+    depth = 0
+    section = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == RECORD_DEPTH - 1:
+                section = elem
+            continue
+
+        depth -= 1
+        if depth == RECORD_DEPTH - 1:
+            attrib = elem.attrib
+            # Packages and configurations store lastTimeActive, events store time. A time that isn't a number
+            # is left out like a missing one, instead of dropping the rest of the file.
+            time = _int_or_none(attrib.get('lastTimeActive', attrib.get('time')))
+            if time is not None:
+                time = absolute_time(time, filename)
+
+            yield UsageRecord(section.tag, time, attrib.get('package'), attrib.get('class'),
+                              _int_or_none(attrib.get('type')), _int_or_none(attrib.get('timeActive')),
+                              _int_or_none(attrib.get('appLaunchCount')), dict(attrib))
+
+            # Drop the element (and the reference from its section) now that it has been processed
+            elem.clear()
+            section.clear()
+        elif depth == RECORD_DEPTH - 2 and section is not None:
+            section.clear()
+            section = None